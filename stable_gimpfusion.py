@@ -6,23 +6,89 @@
 # Thin API client for Automatic1111's StableDiffusion API
 # https://github.com/AUTOMATIC1111/stable-diffusion-webui
 
+import argparse
 import base64
+import BaseHTTPServer
+import getpass
+import hashlib
+import httplib
 import json
+import math
 import os
 import random
+import re
+import select
+import shutil
+import socket
+import SocketServer
+import subprocess
+import sys
 import tempfile
+import threading
+import time
 import logging
 import urllib
 import urllib2
-
-import gimp
-import gimpenums
-import gimpfu
+import urlparse
+import uuid
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    # optional, used for pixel operations like feathered compositing
+    numpy = None
+
+try:
+    import gimp
+    import gimpenums
+    import gimpfu
+except ImportError:
+    # running as a command line tool outside of GIMP, see main()
+    gimp = gimpenums = gimpfu = None
 
 VERSION = 14
 PLUGIN_NAME = "StableGimpfusion"
 PLUGIN_VERSION_URL = "https://raw.githubusercontent.com/ArtBIT/stable-gimpfusion/main/version.json"
 MAX_BATCH_SIZE = 20
+BACKGROUND_JOB_CHANNEL_PREFIX = "GimpFusion job "
+# Selections of text to image results that are masked once fitted, see fitResults
+FIT_SELECTION_CHANNEL_PREFIX = "GimpFusion fit "
+# Prefetch workers stop after this many seconds without their results being used, at most this many payloads are kept
+PREFETCH_IDLE_TIMEOUT = 600
+PREFETCH_MAX_PAYLOADS = 4
+# Background and prefetch workers count as gone once their heartbeat file is older than this many seconds
+WORKER_HEARTBEAT_TIMEOUT = 30
+# Endpoints whose latency is tracked by LatencyStats
+GENERATION_ENDPOINTS = ["/sdapi/v1/txt2img", "/sdapi/v1/img2img"]
+# Latency histogram buckets grow geometrically from 50ms, four buckets per doubling
+LATENCY_BUCKET_BASE = 0.05
+LATENCY_BUCKET_GROWTH = 2 ** 0.25
+# Counts are halved once a histogram holds more samples than this, so old sessions fade out
+LATENCY_HISTORY_SIZE = 500
+# Limits of what the deadline planner may reduce a request to, and how many measured generations it needs first
+DEADLINE_MIN_STEPS = 12
+DEADLINE_MIN_PIXELS = 384 * 384
+DEADLINE_MIN_SAMPLES = 3
+# Text to image resolutions are planned in multiples the backend handles efficiently, preferring the largest size whose
+# aspect ratio is within this (log) distance of the selection
+RESOLUTION_MULTIPLE = 64
+RESOLUTION_ASPECT_TOLERANCE = 0.05
+# Priority classes of the shared queue server in the order they are served, and how often waiting requests poll their position
+QUEUE_PRIORITIES = ["interactive", "normal", "bulk"]
+QUEUE_POLL_INTERVAL = 1.0
+QUEUE_STATUS_ENDPOINT = "/gimpfusion/queue"
+# Bodies to and from remote backends are gzip compressed at this level, fast is what matters for base64 images
+COMPRESSION_LEVEL = 1
+# Response header of servers that accept gzip compressed request bodies, like the queue server
+ACCEPT_ENCODING_HEADER = "X-GimpFusion-Accept-Encoding"
+# Size of the chunks the request body is streamed in, base64 is read in multiples of 3 bytes so chunks can be concatenated
+REQUEST_CHUNK_SIZE = 64 * 1024
+BASE64_READ_SIZE = 3 * 16 * 1024
+RESPONSE_CHUNK_SIZE = 64 * 1024
+# Strings at least this long that look like base64 are recorded as blobs in traffic traces
+BLOB_MIN_SIZE = 1024
+BASE64_PATTERN = re.compile(r"^[A-Za-z0-9+/]+={0,2}$")
 
 # Initialize debugging
 if os.environ.get('DEBUG'):
@@ -61,7 +127,10 @@ STABLE_GIMPFUSION_DEFAULT_SETTINGS = {
         "models": [],
         "cn_models": [],
         "sd_model_checkpoint": None,
-        "is_server_running": False
+        "is_server_running": False,
+        "target_seconds": 0,
+        "prefetch_count": 0,
+        "shard_backends": ""
         }
 
 RESIZE_MODES = {
@@ -71,6 +140,19 @@ RESIZE_MODES = {
         "Just Resize (Latent Upscale)": 3
         }
 
+# (name, horizontal factor, vertical factor) of where the original canvas ends up
+OUTPAINTING_ANCHORS = [
+        ("Center", 0.5, 0.5),
+        ("Top Left", 0.0, 0.0),
+        ("Top", 0.5, 0.0),
+        ("Top Right", 1.0, 0.0),
+        ("Left", 0.0, 0.5),
+        ("Right", 1.0, 0.5),
+        ("Bottom Left", 0.0, 1.0),
+        ("Bottom", 0.5, 1.0),
+        ("Bottom Right", 1.0, 1.0),
+        ]
+
 CONTROL_MODES = {
     "Balanced": 0,
     "My prompt is more important": 1,
@@ -123,6 +205,12 @@ CONTROLNET_MODULES = [
         "binary"
         ]
 
+# Modules that produce an annotator map which can be detected once and reused
+CONTROLNET_DETECT_MODULES = [module for module in CONTROLNET_MODULES if module not in ("none", "clip_vision")]
+CONTROLNET_DETECT_CACHE_SIZE = 64
+# Modules simple enough to run locally with NumPy, instead of uploading the full resolution image to the preprocessor
+LOCAL_CONTROLNET_PREPROCESSORS = ["canny", "binary", "color", "scribble"]
+
 CONTROLNET_DEFAULT_SETTINGS = {
       "input_image": "",
       "mask": "",
@@ -164,6 +252,237 @@ GENERATION_MESSAGES = [
 def roundToMultiple(value, multiple):
     return multiple * round(float(value)/multiple)
 
+def planResolution(width, height, max_pixels, multiple=RESOLUTION_MULTIPLE):
+    """ The generation size for a width x height target: the largest size in multiples of `multiple` that fits into
+    max_pixels with an aspect ratio close to the target, or the closest aspect ratio if none is close enough """
+    if height > width:
+        # search along the long side, the short one can not go below `multiple`
+        planned_height, planned_width = planResolution(height, width, max_pixels, multiple)
+        return planned_width, planned_height
+    aspect = float(width) / height
+    max_pixels = int(max_pixels)
+    best = None
+    for w in range(multiple, max_pixels // multiple + 1, multiple):
+        limit = max_pixels // w // multiple * multiple
+        for h in set([int(w / aspect) // multiple * multiple, int(math.ceil(w / aspect / multiple)) * multiple]):
+            if h < multiple or h > limit:
+                continue
+            error = abs(math.log(float(w) / h / aspect))
+            score = (error > RESOLUTION_ASPECT_TOLERANCE, error if error > RESOLUTION_ASPECT_TOLERANCE else -w * h, error)
+            if best is None or score < best[0]:
+                best = (score, w, h)
+    if best is None:
+        return multiple, multiple
+    return best[1], best[2]
+
+def getOutpaintingStrips(x, y, width, height, canvas_width, canvas_height, margin):
+    """ Split the area around the original (x, y, width, height) rect into border strips.
+    Each strip is (name, region, new_area) where region includes `margin` pixels of
+    the original canvas as context and new_area is the part that needs to be generated.
+    Left and right strips span the full height, top and bottom only the original width,
+    so the strips never overlap in the generated area. """
+    strips = []
+    right = x + width
+    bottom = y + height
+    if x > 0:
+        x2 = min(canvas_width, x + margin)
+        strips.append(("left", (0, 0, x2, canvas_height), (0, 0, x, canvas_height)))
+    if right < canvas_width:
+        x1 = max(0, right - margin)
+        strips.append(("right", (x1, 0, canvas_width - x1, canvas_height), (right, 0, canvas_width - right, canvas_height)))
+    if y > 0:
+        y2 = min(canvas_height, y + margin)
+        strips.append(("top", (x, 0, width, y2), (x, 0, width, y)))
+    if bottom < canvas_height:
+        y1 = max(0, bottom - margin)
+        strips.append(("bottom", (x, y1, width, canvas_height - y1), (x, bottom, width, canvas_height - bottom)))
+    return strips
+
+def getPixels(drawable, x, y, width, height):
+    """ Read a (height, width, bpp) uint8 array from the drawable, coordinates are drawable local """
+    region = drawable.get_pixel_rgn(x, y, width, height, False, False)
+    return numpy.frombuffer(region[x:x + width, y:y + height], dtype=numpy.uint8).reshape(height, width, drawable.bpp)
+
+def setPixels(drawable, x, y, pixels):
+    """ Write a (height, width, bpp) uint8 array to the drawable, coordinates are drawable local """
+    height, width = pixels.shape[:2]
+    region = drawable.get_pixel_rgn(x, y, width, height, True, False)
+    region[x:x + width, y:y + height] = numpy.ascontiguousarray(pixels, dtype=numpy.uint8).tobytes()
+    drawable.flush()
+    drawable.update(x, y, width, height)
+
+def boxBlur(values, radius, axis):
+    """ Moving average of a 2D array along one axis, edges are extended """
+    size = 2 * radius + 1
+    padding = [(0, 0), (0, 0)]
+    padding[axis] = (radius + 1, radius)
+    summed = numpy.cumsum(numpy.pad(values, padding, mode="edge"), axis=axis)
+    length = values.shape[axis]
+    upper = summed.take(numpy.arange(size, size + length), axis=axis)
+    lower = summed.take(numpy.arange(0, length), axis=axis)
+    return (upper - lower) / float(size)
+
+def featherMask(mask, radius):
+    """ Three box blur passes approximate a gaussian blur of the given radius """
+    radius = int(radius)
+    if radius < 1:
+        return mask
+    for i in range(3):
+        mask = boxBlur(boxBlur(mask, radius, 0), radius, 1)
+    return mask
+
+def getBorderMask(region, new_area, feather):
+    """ Alpha over the (x, y, width, height) region that is 1 on new_area and fades out within the context around it,
+    so a generated strip blends into the original instead of ending in a seam at the old border """
+    x, y, width, height = region
+    new_x, new_y, new_width, new_height = new_area[0] - x, new_area[1] - y, new_area[2], new_area[3]
+    # three box blur passes reach 3 * feather, growing by that much keeps the fade out of the generated area,
+    # and the fade has to end within the context
+    feather = min(int(feather), max(width - new_width, height - new_height) // 6)
+    grow = 3 * feather
+    mask = numpy.zeros((height, width), dtype=numpy.float32)
+    mask[max(0, new_y - grow):new_y + new_height + grow, max(0, new_x - grow):new_x + new_width + grow] = 1.0
+    mask = featherMask(mask, feather)
+    mask[new_y:new_y + new_height, new_x:new_x + new_width] = 1.0
+    return mask
+
+def shiftPixels(values, dy, dx):
+    """ values[y + dy, x + dx] for every y, x of a 2D array, edges are extended """
+    padded = numpy.pad(values, [(abs(dy), abs(dy)), (abs(dx), abs(dx))], mode="edge")
+    height, width = values.shape
+    return padded[abs(dy) + dy:abs(dy) + dy + height, abs(dx) + dx:abs(dx) + dx + width]
+
+def resizeNearest(pixels, width, height):
+    rows = (numpy.arange(height) * pixels.shape[0] // height).astype(numpy.intp)
+    columns = (numpy.arange(width) * pixels.shape[1] // width).astype(numpy.intp)
+    return pixels[rows][:, columns]
+
+def cannyEdges(gray, low, high):
+    """ Canny edge detector like cv2.Canny used by the canny module: no blur, 3x3 Sobel and the L1 gradient norm,
+    so the same thresholds give the same map """
+    gx = (shiftPixels(gray, -1, 1) + 2 * shiftPixels(gray, 0, 1) + shiftPixels(gray, 1, 1)
+        - shiftPixels(gray, -1, -1) - 2 * shiftPixels(gray, 0, -1) - shiftPixels(gray, 1, -1))
+    gy = (shiftPixels(gray, 1, -1) + 2 * shiftPixels(gray, 1, 0) + shiftPixels(gray, 1, 1)
+        - shiftPixels(gray, -1, -1) - 2 * shiftPixels(gray, -1, 0) - shiftPixels(gray, -1, 1))
+    magnitude = numpy.abs(gx) + numpy.abs(gy)
+
+    # non maximum suppression along the gradient direction, quantized to 0, 45, 90 and 135 degrees
+    angle = (numpy.rad2deg(numpy.arctan2(gy, gx)) + 180.0) % 180.0
+    direction = (((angle + 22.5) // 45) % 4).astype(numpy.int8)
+    neighbours = [((0, 1), (0, -1)), ((1, 1), (-1, -1)), ((1, 0), (-1, 0)), ((1, -1), (-1, 1))]
+    maximum = numpy.zeros(gray.shape, dtype=bool)
+    for index, ((dy1, dx1), (dy2, dx2)) in enumerate(neighbours):
+        # ties go to one side only, so a step edge stays one pixel wide
+        is_maximum = (magnitude > shiftPixels(magnitude, dy1, dx1)) & (magnitude >= shiftPixels(magnitude, dy2, dx2))
+        maximum |= (direction == index) & is_maximum
+    magnitude = numpy.where(maximum, magnitude, 0)
+
+    # hysteresis, flood fill from the strong pixels over the weak ones, only the sparse weak coordinates are visited
+    width = gray.shape[1]
+    remaining = set(numpy.flatnonzero(magnitude >= low).tolist())
+    stack = numpy.flatnonzero(magnitude >= high).tolist()
+    remaining.difference_update(stack)
+    kept = list(stack)
+    while stack:
+        index = stack.pop()
+        column = index % width
+        neighbours = [index - width, index + width]
+        if column > 0:
+            neighbours += [index - width - 1, index - 1, index + width - 1]
+        if column < width - 1:
+            neighbours += [index - width + 1, index + 1, index + width + 1]
+        for neighbour in neighbours:
+            if neighbour in remaining:
+                remaining.remove(neighbour)
+                stack.append(neighbour)
+                kept.append(neighbour)
+    edges = numpy.zeros(gray.shape, dtype=bool)
+    edges.flat[kept] = True
+    return edges
+
+def resizeAxis(values, length, axis):
+    """ Resize a float array along one axis, averaging the covered area when shrinking
+    and interpolating linearly when growing """
+    source_length = values.shape[axis]
+    scale = float(source_length) / length
+    shape = [1] * values.ndim
+    shape[axis] = length
+    if scale > 1:
+        # integrate the pixels as boxes and take the mean over each output pixel span
+        summed = numpy.cumsum(values, axis=axis)
+        summed = numpy.concatenate([numpy.zeros_like(summed.take([0], axis=axis)), summed], axis=axis)
+        def integral(positions):
+            lower = numpy.minimum(numpy.floor(positions).astype(numpy.intp), source_length - 1)
+            fraction = (positions - lower).reshape(shape)
+            return summed.take(lower, axis=axis) + fraction * (summed.take(lower + 1, axis=axis) - summed.take(lower, axis=axis))
+        edges = numpy.arange(length + 1) * scale
+        return (integral(edges[1:]) - integral(edges[:-1])) / scale
+    positions = numpy.clip((numpy.arange(length) + 0.5) * scale - 0.5, 0, source_length - 1)
+    lower = numpy.floor(positions).astype(numpy.intp)
+    upper = numpy.minimum(lower + 1, source_length - 1)
+    fraction = (positions - lower).reshape(shape)
+    return values.take(lower, axis=axis) * (1 - fraction) + values.take(upper, axis=axis) * fraction
+
+def resizeImage(pixels, width, height):
+    """ Resize a (height, width, channels) uint8 array, area averaging when shrinking like cv2.INTER_AREA """
+    resized = resizeAxis(resizeAxis(pixels.astype(numpy.float64), height, 0), width, 1)
+    return numpy.clip(numpy.round(resized), 0, 255).astype(numpy.uint8)
+
+def preprocessControlNetImage(module, pixels, processor_res, threshold_a, threshold_b):
+    """ NumPy versions of the simple ControlNet preprocessors, returns a (height, width, 3) uint8 map
+    with its short side scaled to processor_res and rounded to 64, like the extension does """
+    rgb = pixels[:, :, :3] if pixels.shape[2] >= 3 else numpy.repeat(pixels[:, :, :1], 3, axis=2)
+    height, width = rgb.shape[:2]
+    # the short side goes to processor_res and both sides to multiples of 64, like the extension's resize_image
+    scale = float(max(64, processor_res)) / min(height, width)
+    rgb = resizeImage(rgb, max(64, int(round(width * scale / 64.0)) * 64), max(64, int(round(height * scale / 64.0)) * 64))
+    height, width = rgb.shape[:2]
+    gray = numpy.dot(rgb.astype(numpy.float32), numpy.array([0.299, 0.587, 0.114], dtype=numpy.float32))
+
+    if module == "canny":
+        detected = cannyEdges(gray, threshold_a, threshold_b)
+    elif module == "binary":
+        detected = gray <= threshold_a
+    elif module == "scribble":
+        detected = rgb.min(axis=2) < 127
+    elif module == "color":
+        # average colors over a grid of 64 pixel cells
+        rows = numpy.arange(max(1, height // 64) + 1) * height // max(1, height // 64)
+        columns = numpy.arange(max(1, width // 64) + 1) * width // max(1, width // 64)
+        cells = numpy.add.reduceat(numpy.add.reduceat(rgb.astype(numpy.float64), rows[:-1], axis=0), columns[:-1], axis=1)
+        cells /= numpy.outer(numpy.diff(rows), numpy.diff(columns))[:, :, numpy.newaxis]
+        return resizeNearest(cells.astype(numpy.uint8), width, height)
+    else:
+        raise Exception("There is no local %s preprocessor" % module)
+    return numpy.repeat((detected * 255).astype(numpy.uint8)[:, :, numpy.newaxis], 3, axis=2)
+
+def getMaxImages(data):
+    """ Number of images worth reading from a generation response, None to read them all """
+    if isinstance(data, dict) and data.get("override_settings", {}).get("control_net_no_detectmap"):
+        return data.get("batch_size", 1) * data.get("n_iter", 1)
+    return None
+
+def getRequestPriority(data):
+    """ Queue priority class of a request made while the user waits, single images count as interactive previews """
+    if isinstance(data, dict) and data.get("batch_size", 1) * data.get("n_iter", 1) > 1:
+        return "normal"
+    return "interactive"
+
+def isLocalUrl(url):
+    """ Whether a backend runs on this machine, where compression would only cost CPU """
+    hostname = urlparse.urlsplit(url).hostname or ""
+    return hostname in ("localhost", "::1") or hostname.startswith("127.")
+
+def getQueueUser():
+    """ Identifies this plugin instance to a shared queue server, for fairness between users """
+    try:
+        return "%s@%s" % (getpass.getuser(), socket.gethostname())
+    except Exception as e:
+        return "unknown"
+
+def isBase64Blob(value):
+    return isinstance(value, basestring) and len(value) >= BLOB_MIN_SIZE and len(value) % 4 == 0 and BASE64_PATTERN.match(value) is not None
+
 def deunicodeDict(data):
     """Recursively converts dictionary keys to strings."""
     if isinstance(data, unicode):
@@ -173,45 +492,629 @@ def deunicodeDict(data):
     return dict((str(k), deunicodeDict(v)) 
         for k, v in data.items())
 
+class Base64File():
+    """ Base64 representation of a file, encoded on the fly whenever it is read """
+    def __init__(self, filepath):
+        self.filepath = filepath
+
+    def chunks(self):
+        with open(self.filepath, "rb") as f:
+            while True:
+                data = f.read(BASE64_READ_SIZE)
+                if not data:
+                    break
+                yield base64.b64encode(data)
+
+    def read(self):
+        return "".join(self.chunks())
+
+    def hash(self, digest):
+        """ Feed the raw file content to a hashlib digest """
+        with open(self.filepath, "rb") as f:
+            while True:
+                data = f.read(BASE64_READ_SIZE)
+                if not data:
+                    break
+                digest.update(data)
+        return digest
+
+def iterjson(data):
+    """ Serialize data to JSON piece by piece, Base64File values are streamed instead of being held in memory """
+    if isinstance(data, Base64File):
+        yield '"'
+        for chunk in data.chunks():
+            yield chunk
+        yield '"'
+    elif isinstance(data, dict):
+        separator = "{"
+        for key, value in sorted(data.items()):
+            yield separator + json.dumps(str(key)) + ": "
+            for piece in iterjson(value):
+                yield piece
+            separator = ", "
+        yield "}" if separator == ", " else "{}"
+    elif isinstance(data, (list, tuple)):
+        separator = "["
+        for value in data:
+            yield separator
+            for piece in iterjson(value):
+                yield piece
+            separator = ", "
+        yield "]" if separator == ", " else "[]"
+    else:
+        yield json.dumps(data)
+
+class ResponseReader():
+    """ Incremental JSON reader for generation responses. Strings in the top level "images" list past
+    max_images are dropped while they stream by, so unwanted annotator maps never end up in memory. """
+    def __init__(self, max_images=None):
+        self.max_images = max_images
+        self.parts = []
+        self.depth = 0
+        self.in_string = False
+        self.skipping = False
+        self.backslashes = 0
+        self.key = None
+        self.last_string = None
+        self.expect_images = False
+        self.in_images = False
+        self.image_index = 0
+        self.kept_images = 0
+
+    def feed(self, chunk):
+        i = 0
+        length = len(chunk)
+        while i < length:
+            if self.in_string:
+                end = chunk.find('"', i)
+                segment = chunk[i:length if end == -1 else end]
+                # an odd number of backslashes right before the quote escapes it
+                stripped = segment.rstrip("\\")
+                if stripped:
+                    self.backslashes = len(segment) - len(stripped)
+                else:
+                    self.backslashes += len(segment)
+                if not self.skipping:
+                    self.parts.append(segment)
+                    if self.key is not None and len(self.key) < 64:
+                        self.key += segment[:64]
+                if end == -1:
+                    break
+                i = end + 1
+                if self.backslashes % 2 == 1:
+                    self.backslashes = 0
+                    if not self.skipping:
+                        self.parts.append('"')
+                    continue
+                self.in_string = False
+                self.backslashes = 0
+                if not self.skipping:
+                    self.parts.append('"')
+                self.skipping = False
+                self.last_string = self.key
+                self.key = None
+                continue
+
+            char = chunk[i]
+            i += 1
+            if self.in_images and self.depth == 2 and char != "]":
+                if char == '"':
+                    self.in_string = True
+                    if self.max_images is not None and self.image_index >= self.max_images:
+                        self.skipping = True
+                    else:
+                        # separators are written here instead of when they are read, as the next element might be dropped
+                        if self.kept_images > 0:
+                            self.parts.append(",")
+                        self.parts.append('"')
+                        self.kept_images += 1
+                    self.image_index += 1
+                continue
+
+            self.parts.append(char)
+            if char == '"':
+                self.in_string = True
+                self.key = "" if self.depth == 1 else None
+            elif char == ":":
+                self.expect_images = self.depth == 1 and self.last_string == "images"
+            elif char in "{[":
+                self.depth += 1
+                if char == "[" and self.expect_images and self.depth == 2:
+                    self.in_images = True
+                self.expect_images = False
+            elif char in "}]":
+                if self.in_images and self.depth == 2:
+                    self.in_images = False
+                self.depth -= 1
+
+    def result(self):
+        return json.loads("".join(self.parts))
+
 class ApiClient():
     """ Simple API client used to interface with StableDiffusion JSON endpoints """
     def __init__(self, base_url):
         self.setBaseUrl(base_url)
+        self.recorder = TrafficRecorder.fromEnvironment()
+        # queue server priority class, None picks it per request, see getRequestPriority
+        self.priority = None
+        # called with (position, running) while a request waits in a queue server
+        self.on_queued = None
 
     def setBaseUrl(self, base_url):
         self.base_url = base_url
+        self.compress = not isLocalUrl(base_url)
+        # only once the server said it can take them, see ACCEPT_ENCODING_HEADER
+        self.compress_requests = False
+
+    def negotiate(self, response):
+        """ Switch to compressed request bodies if the server accepts them """
+        if self.compress and "gzip" in (response.getheader(ACCEPT_ENCODING_HEADER) or ""):
+            self.compress_requests = True
+
+    def connect(self, url):
+        parts = urlparse.urlsplit(url)
+        if parts.scheme == "https":
+            connection = httplib.HTTPSConnection(parts.netloc)
+        else:
+            connection = httplib.HTTPConnection(parts.netloc)
+        return connection, parts.path + "?" + parts.query
+
+    def writeChunked(self, connection, data, compress=False):
+        """ Stream data as JSON using chunked transfer encoding, gzip compressed if asked to, returns the number of body bytes sent """
+        pieces = gzipPieces(iterjson(data)) if compress else iterjson(data)
+        total = 0
+        pending = []
+        pending_size = 0
+        for piece in pieces:
+            pending.append(piece)
+            pending_size += len(piece)
+            if pending_size >= REQUEST_CHUNK_SIZE:
+                connection.send("%x\r\n%s\r\n" % (pending_size, "".join(pending)))
+                total += pending_size
+                pending = []
+                pending_size = 0
+        if pending_size > 0:
+            connection.send("%x\r\n%s\r\n" % (pending_size, "".join(pending)))
+            total += pending_size
+        connection.send("0\r\n\r\n")
+        return total
+
+    def readResponse(self, response, max_images=None):
+        """ Returns the decoded JSON response and its size in bytes as received """
+        decompressor = None
+        if (response.getheader("Content-Encoding") or "").lower() == "gzip":
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if max_images is None:
+            body = response.read()
+            return json.loads(decompressor.decompress(body) if decompressor else body), len(body)
+        reader = ResponseReader(max_images)
+        size = 0
+        while True:
+            chunk = response.read(RESPONSE_CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            reader.feed(decompressor.decompress(chunk) if decompressor else chunk)
+        return reader.result(), size
+
+    def waitForTicket(self, connection, ticket):
+        """ Report the queue position of a sent request through on_queued until its response starts arriving.
+        Backends that are not a queue server answer the first poll with 404, which ends the polling. """
+        while not select.select([connection.sock], [], [], QUEUE_POLL_INTERVAL)[0]:
+            try:
+                url = self.base_url + QUEUE_STATUS_ENDPOINT + "?" + urllib.urlencode({"ticket": ticket})
+                status = json.loads(urllib2.urlopen(url, timeout=QUEUE_POLL_INTERVAL).read())
+            except Exception as e:
+                return
+            if status.get("position") is None:
+                return
+            self.on_queued(status["position"], status["running"])
 
     def post(self, endpoint, data={}, params={}, headers=None):
+        started = time.time()
+        status = None
+        request_bytes = 0
+        response_bytes = 0
+        result = None
         try:
             url = self.base_url + endpoint + "?" + urllib.urlencode(params)
             logging.debug("POST %s" % url)
-            data = json.dumps(data)
-
-            logging.debug('post data %s', data)
 
             headers = headers or {"Content-Type": "application/json", "Accept": "application/json"}
-            request = urllib2.Request(url=url, data=data, headers=headers)
-            response = urllib2.urlopen(request)
-            data = response.read()
-            data = json.loads(data)
-
-            logging.debug('response: %s', data)
-            return data
+            ticket = str(uuid.uuid4())
+            connection, path = self.connect(url)
+            try:
+                connection.putrequest("POST", path)
+                for name, value in headers.items():
+                    connection.putheader(name, value)
+                connection.putheader("Transfer-Encoding", "chunked")
+                if self.compress:
+                    connection.putheader("Accept-Encoding", "gzip")
+                if self.compress_requests:
+                    connection.putheader("Content-Encoding", "gzip")
+                # ignored by the backend itself, used by a shared queue server in front of it
+                connection.putheader("X-GimpFusion-User", getQueueUser())
+                connection.putheader("X-GimpFusion-Priority", self.priority or getRequestPriority(data))
+                connection.putheader("X-GimpFusion-Ticket", ticket)
+                connection.endheaders()
+                request_bytes = self.writeChunked(connection, data, self.compress_requests)
+                # progress can only be reported from the main thread
+                if self.on_queued is not None and threading.current_thread().name == "MainThread":
+                    self.waitForTicket(connection, ticket)
+
+                response = connection.getresponse()
+                status = response.status
+                self.negotiate(response)
+                if response.status >= 400:
+                    raise Exception("HTTP %d %s: %s" % (response.status, response.reason, response.read(1000)))
+                result, response_bytes = self.readResponse(response, getMaxImages(data))
+            finally:
+                connection.close()
+
+            logging.debug("POST %s sent %d bytes, received %d bytes in %.2fs", endpoint, request_bytes, response_bytes, time.time() - started)
+            return result
         except Exception as ex:
             logging.exception("ERROR: ApiClient.post")
+        finally:
+            if self.recorder is not None:
+                self.recorder.record("POST", endpoint, params, data, result, status, started, time.time() - started, request_bytes, response_bytes)
+            if result is not None and endpoint in GENERATION_ENDPOINTS:
+                LatencyStats().record(getRequestDimensions(self.base_url, endpoint, data), time.time() - started, request_bytes, response_bytes, getRequestWork(data))
 
     def get(self, endpoint, params={}, headers=None):
+        started = time.time()
+        status = None
+        response_bytes = 0
+        result = None
         try:
             url = self.base_url + endpoint + "?" + urllib.urlencode(params)
-            logging.debug("POST %s" % url)
-            headers = headers or {"Content-Type": "application/json", "Accept": "application/json"}
+            logging.debug("GET %s" % url)
+            headers = dict(headers or {"Content-Type": "application/json", "Accept": "application/json"})
+            if self.compress:
+                headers["Accept-Encoding"] = "gzip"
             request = urllib2.Request(url=url, headers=headers)
             response = urllib2.urlopen(request)
+            status = response.getcode()
+            self.negotiate(response.info())
             data = response.read()
-            data = json.loads(data)
-            return data
+            response_bytes = len(data)
+            if (response.info().getheader("Content-Encoding") or "").lower() == "gzip":
+                data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+            result = json.loads(data)
+            return result
         except Exception as ex:
             logging.exception("ERROR: ApiClient.get")
+        finally:
+            if self.recorder is not None:
+                self.recorder.record("GET", endpoint, params, None, result, status, started, time.time() - started, 0, response_bytes)
+
+
+class TrafficRecorder():
+    """ Records API traffic as a compact trace, image blobs are stored once in content addressed files.
+    Enabled by pointing GIMPFUSION_TRACE at a directory, or by setting DEBUG. """
+    def __init__(self, path):
+        self.path = path
+        self.blobs_path = os.path.join(path, "blobs")
+        self.trace_path = os.path.join(path, "trace.jsonl")
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def fromEnvironment():
+        path = os.environ.get("GIMPFUSION_TRACE")
+        if not path and DEBUG:
+            path = os.path.join(tempfile.gettempdir(), "stable_gimpfusion_trace")
+        if path:
+            return TrafficRecorder(path)
+        return None
+
+    def storeBlob(self, source):
+        digest = hashlib.sha1()
+        if isinstance(source, Base64File):
+            raw = None
+            source.hash(digest)
+        else:
+            raw = base64.b64decode(source)
+            digest.update(raw)
+        name = digest.hexdigest()
+        filepath = os.path.join(self.blobs_path, name)
+        if not os.path.isfile(filepath):
+            if not os.path.isdir(self.blobs_path):
+                os.makedirs(self.blobs_path)
+            if raw is None:
+                shutil.copyfile(source.filepath, filepath)
+            else:
+                with open(filepath, "wb") as f:
+                    f.write(raw)
+        return {"$blob": name, "size": os.path.getsize(filepath)}
+
+    def redact(self, data):
+        """ Replace image payloads with references to blob files """
+        if isinstance(data, Base64File) or isBase64Blob(data):
+            return self.storeBlob(data)
+        if isinstance(data, dict):
+            return dict((key, self.redact(value)) for key, value in data.items())
+        if isinstance(data, (list, tuple)):
+            return [self.redact(value) for value in data]
+        return data
+
+    def restore(self, data, streamed=True):
+        """ Inverse of redact, blobs come back as Base64File (or base64 strings if not streamed) """
+        if isinstance(data, dict):
+            if "$blob" in data:
+                blob = Base64File(os.path.join(self.blobs_path, data["$blob"]))
+                return blob if streamed else blob.read()
+            return dict((str(key), self.restore(value, streamed)) for key, value in data.items())
+        if isinstance(data, list):
+            return [self.restore(value, streamed) for value in data]
+        return data
+
+    def record(self, method, endpoint, params, request, response, status, started, duration, request_bytes, response_bytes):
+        try:
+            with self.lock:
+                entry = {
+                    "method": method,
+                    "endpoint": endpoint,
+                    "params": params,
+                    "status": status,
+                    "started": started,
+                    "duration": duration,
+                    "request_bytes": request_bytes,
+                    "response_bytes": response_bytes,
+                    "request": self.redact(request),
+                    "response": self.redact(response),
+                }
+                with open(self.trace_path, "a") as f:
+                    f.write(json.dumps(entry, sort_keys=True) + "\n")
+        except Exception as ex:
+            logging.exception("ERROR: TrafficRecorder.record")
+
+    def load(self):
+        entries = []
+        with open(self.trace_path, "r") as f:
+            for line in f:
+                if line.strip():
+                    entries.append(deunicodeDict(json.loads(line)))
+        entries.sort(key=lambda entry: entry["started"])
+        return entries
+
+
+
+def gzipPieces(pieces):
+    """ gzip compress a stream of strings, piece by piece """
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for piece in pieces:
+        yield compressor.compress(piece)
+    yield compressor.flush()
+
+def getRequestDimensions(base_url, endpoint, data):
+    """ The dimensions a generation request is tracked by in LatencyStats """
+    shelf = settings or MyShelf(STABLE_GIMPFUSION_DEFAULT_SETTINGS)
+    return {
+        "endpoint": endpoint,
+        "backend": base_url,
+        "checkpoint": shelf.get("sd_model_checkpoint") or "unknown",
+        "resolution": "%dx%d" % (data.get("width", 0), data.get("height", 0)),
+        "steps": data.get("steps"),
+        "batch_size": data.get("batch_size", 1),
+        "sampler": data.get("sampler_index"),
+    }
+
+def getRequestWork(data):
+    """ Denoising work of a generation request in step megapixels, img2img only runs the denoised part of the steps """
+    steps = data.get("steps", 0)
+    if data.get("init_images"):
+        steps = steps * data.get("denoising_strength", 1.0)
+    megapixels = data.get("width", 0) * data.get("height", 0) / 1000000.0
+    return steps * megapixels * data.get("batch_size", 1) * data.get("n_iter", 1)
+
+def getThroughputKey(checkpoint, sampler):
+    return "%s|%s" % (checkpoint, sampler)
+
+def planForDeadline(data, deadline, model):
+    """ Reduce batch size, then steps, then resolution until the estimated latency fits the deadline.
+    model is the (overhead seconds, step megapixels per second) of the checkpoint and sampler. """
+    overhead, throughput = model
+    budget = max(0.0, deadline - overhead) * throughput
+    plan = {
+        "target_seconds": deadline,
+        "steps": data["steps"],
+        "width": data["width"],
+        "height": data["height"],
+        "batch_size": data.get("batch_size", 1),
+    }
+
+    def work():
+        return getRequestWork(dict(data, **plan))
+
+    if work() > budget:
+        plan["batch_size"] = max(1, min(plan["batch_size"], int(budget / max(work() / plan["batch_size"], 1e-6))))
+    if work() > budget:
+        plan["steps"] = max(min(plan["steps"], DEADLINE_MIN_STEPS), int(plan["steps"] * budget / work()))
+    if work() > budget:
+        # keep the aspect ratio, but not below the smallest resolution the checkpoints produce anything useful at
+        scale = max(math.sqrt(budget / work()), math.sqrt(float(DEADLINE_MIN_PIXELS) / (plan["width"] * plan["height"])))
+        if scale < 1.0:
+            plan["width"] = max(64, int(plan["width"] * scale) // 64 * 64)
+            plan["height"] = max(64, int(plan["height"] * scale) // 64 * 64)
+    plan["estimated_seconds"] = round(overhead + work() / throughput, 1)
+    return plan
+
+class LatencyStats():
+    """ Rolling latency histograms and byte counts per request dimension, plus a linear latency model
+    (fixed overhead + work / throughput) per checkpoint and sampler, kept in a json file next to the shelf """
+    lock = threading.Lock()
+
+    def __init__(self):
+        self.file_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'stable_gimpfusion_stats.json')
+
+    def load(self, strict=False):
+        """ The stats, empty if the file is missing. A file that can not be read raises if strict,
+        so a writer never replaces the history with a single sample. """
+        data = {}
+        try:
+            if os.path.isfile(self.file_path):
+                with open(self.file_path, "r") as f:
+                    data = deunicodeDict(json.load(f))
+        except Exception as e:
+            if strict:
+                raise
+            logging.debug(e)
+        data.setdefault("dimensions", {})
+        data.setdefault("throughput", {})
+        return data
+
+    @staticmethod
+    def bucket(duration):
+        return max(0, int(math.ceil(math.log(max(duration, LATENCY_BUCKET_BASE) / LATENCY_BUCKET_BASE, LATENCY_BUCKET_GROWTH))))
+
+    @staticmethod
+    def bucketLatency(index):
+        """ Upper bound of the bucket, in seconds """
+        return LATENCY_BUCKET_BASE * LATENCY_BUCKET_GROWTH ** index
+
+    def record(self, dimensions, duration, sent, received, work=0):
+        try:
+            with LatencyStats.lock:
+                data = self.load(True)
+                bucket = str(self.bucket(duration))
+                for name, value in dimensions.items():
+                    entry = data["dimensions"].setdefault(name, {}).setdefault(str(value), {"histogram": {}, "count": 0, "sent": 0, "received": 0})
+                    entry["histogram"][bucket] = entry["histogram"].get(bucket, 0) + 1
+                    entry["count"] += 1
+                    entry["sent"] += sent
+                    entry["received"] += received
+                    if entry["count"] > LATENCY_HISTORY_SIZE:
+                        entry["histogram"] = dict((key, count / 2) for key, count in entry["histogram"].items() if count > 1)
+                        entry["count"] = sum(entry["histogram"].values())
+                        entry["sent"] /= 2
+                        entry["received"] /= 2
+
+                if work > 0:
+                    # running sums for a least squares fit of duration = overhead + work / throughput
+                    key = getThroughputKey(dimensions["checkpoint"], dimensions["sampler"])
+                    sums = data["throughput"].setdefault(key, {"n": 0, "w": 0, "t": 0, "ww": 0, "wt": 0})
+                    sums["n"] += 1
+                    sums["w"] += work
+                    sums["t"] += duration
+                    sums["ww"] += work * work
+                    sums["wt"] += work * duration
+                    if sums["n"] > LATENCY_HISTORY_SIZE:
+                        for name in sums:
+                            sums[name] /= 2.0
+
+                # the worker processes record too, the rename makes sure nobody reads a half written file
+                temp_path = "%s.%d.tmp" % (self.file_path, os.getpid())
+                with open(temp_path, "w") as f:
+                    json.dump(data, f)
+                if os.name == "nt" and os.path.isfile(self.file_path):
+                    os.remove(self.file_path)
+                os.rename(temp_path, self.file_path)
+        except Exception as e:
+            logging.exception("ERROR: LatencyStats.record")
+
+    def getThroughputModel(self, checkpoint, sampler):
+        """ (overhead seconds, step megapixels per second), None until a few generations were measured """
+        sums = self.load()["throughput"].get(getThroughputKey(checkpoint, sampler))
+        if sums is None or sums["n"] < DEADLINE_MIN_SAMPLES or sums["w"] <= 0:
+            return None
+        n, w, t, ww, wt = sums["n"], sums["w"], sums["t"], sums["ww"], sums["wt"]
+        denominator = n * ww - w * w
+        slope = (n * wt - w * t) / denominator if denominator > 1e-9 else 0
+        overhead = (t - slope * w) / n
+        if slope <= 0 or overhead < 0:
+            # not enough spread in the work to separate the overhead
+            return 0.0, w / t
+        return overhead, 1.0 / slope
+
+    def percentile(self, histogram, fraction):
+        total = sum(histogram.values())
+        seen = 0
+        for bucket in sorted(histogram.keys(), key=int):
+            seen += histogram[bucket]
+            if seen >= fraction * total:
+                return self.bucketLatency(int(bucket))
+        return 0.0
+
+    def report(self):
+        lines = []
+        data = self.load()
+        for name, values in sorted(data["dimensions"].items()):
+            lines.append(name)
+            for value, entry in sorted(values.items()):
+                histogram = entry["histogram"]
+                count = max(1, sum(histogram.values()))
+                lines.append("    %s: n=%d p50=%.1fs p90=%.1fs p99=%.1fs sent=%dKB received=%dKB" % (value, entry["count"],
+                    self.percentile(histogram, 0.5), self.percentile(histogram, 0.9), self.percentile(histogram, 0.99),
+                    entry["sent"] / count / 1024, entry["received"] / count / 1024))
+        if data["throughput"]:
+            lines.append("throughput (checkpoint|sampler)")
+            for key in sorted(data["throughput"].keys()):
+                model = self.getThroughputModel(*key.split("|", 1))
+                if model is not None:
+                    lines.append("    %s: overhead=%.1fs %.2f step megapixels/s" % (key, model[0], model[1]))
+        return "\n".join(lines)
+
+
+def mergeResponses(responses):
+    """ Combine the responses of sub-batches of the same payload into the response of a single batch.
+    Every sub-batch returns the same annotator images, the ones of the first go last. """
+    images = []
+    annotator_images = []
+    info = None
+    for response in responses:
+        response_info = json.loads(response["info"])
+        count = len(response_info["all_seeds"])
+        images += response["images"][:count]
+        if info is None:
+            annotator_images = response["images"][count:]
+            info = response_info
+        else:
+            for key in ("all_seeds", "all_subseeds", "all_prompts", "all_negative_prompts", "infotexts"):
+                info[key] = info.get(key, []) + response_info.get(key, [])
+    return {"images": images + annotator_images, "parameters": responses[0].get("parameters", {}), "info": json.dumps(info)}
+
+def shardPayload(data, shards):
+    """ Split a batch into up to `shards` sub-batches that generate the same images as the whole batch.
+    Seeds are picked here instead of by the backend, and every sub-batch starts at the seed offset of its
+    first image. With a variation strength the backend keeps the seed and counts up the subseed instead. """
+    batch_size = int(data.get("batch_size", 1))
+    seed = int(data.get("seed") or -1)
+    if seed == -1:
+        seed = random.randrange(4294967294)
+    subseed = int(data.get("subseed") or -1)
+    if subseed == -1:
+        subseed = random.randrange(4294967294)
+    variation = data.get("subseed_strength", 0) != 0
+
+    payloads = []
+    offset = 0
+    for index in range(min(shards, batch_size)):
+        size = batch_size // shards + (1 if index < batch_size % shards else 0)
+        payloads.append(dict(data, batch_size=size, seed=seed if variation else seed + offset, subseed=subseed + offset))
+        offset += size
+    return payloads
+
+def getShardBackends():
+    """ The extra backends large batches are spread over, from the config """
+    shelf = settings or MyShelf(STABLE_GIMPFUSION_DEFAULT_SETTINGS)
+    return [url.strip().rstrip("/") for url in (shelf.get("shard_backends") or "").split(",") if url.strip()]
+
+def post_concurrently(jobs):
+    """ POST a list of (api_client, endpoint, data) jobs in parallel, returns the responses in the same order """
+    responses = [None] * len(jobs)
+
+    def run(index, client, endpoint, data):
+        responses[index] = client.post(endpoint, data)
+
+    threads = []
+    for index, (client, endpoint, data) in enumerate(jobs):
+        thread = threading.Thread(target=run, args=(index, client, endpoint, data))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return responses
 
 
 """ Get the StableDiffusion data needed for dynamic gimpfu.PF_OPTION lists """
@@ -283,6 +1186,8 @@ class StableGimpfusionPlugin():
 
         try:
             self.api = api
+            self.api.on_queued = self.showQueuePosition
+            self.queue_position = 0
             self.files = TempFiles()
         except Exception as e:
             logging.exception("ERROR: StableGimpfusionPlugin.__init__")
@@ -290,6 +1195,16 @@ class StableGimpfusionPlugin():
     def showMessage(self, text):
         gimp.pdb.gimp_message(text)
 
+    def showQueuePosition(self, position, running):
+        """ Progress text while a request waits in a shared queue server """
+        if running:
+            if self.queue_position:
+                gimp.pdb.gimp_progress_set_text(random.choice(GENERATION_MESSAGES))
+            self.queue_position = 0
+        elif position != self.queue_position:
+            gimp.pdb.gimp_progress_set_text("Waiting for the shared backend, %d requests ahead..." % (position - 1))
+            self.queue_position = position
+
     def checkUpdate(self):
         try:
             gimp.get_data("update_checked")
@@ -353,6 +1268,25 @@ class StableGimpfusionPlugin():
     def getActiveMaskAsBase64(self):
         return self.getLayerMaskAsBase64(self.image.active_layer)
 
+    def getRegionAsBase64(self, source, x, y, width, height):
+        """ Export the (x, y, width, height) rect of the source layer, in image coordinates """
+        active_layer = self.image.active_layer
+        region = Layer(source).copy().insert().crop(x, y, width, height)
+        result = region.toBase64()
+        region.remove()
+        gimp.pdb.gimp_image_set_active_layer(self.image, active_layer)
+        return result
+
+    def getRegionMaskAsBase64(self, x, y, width, height):
+        """ Export the current selection, cropped to the (x, y, width, height) rect, as a mask """
+        active_layer = self.image.active_layer
+        tmp_layer = Layer.create(self.image, "mask", width, height, gimpenums.RGBA_IMAGE, 100, gimpenums.NORMAL_MODE)
+        tmp_layer.translate((x, y)).addSelectionAsMask().insert()
+        result = tmp_layer.maskToBase64()
+        tmp_layer.remove()
+        gimp.pdb.gimp_image_set_active_layer(self.image, active_layer)
+        return result
+
     def getSelectionBounds(self):
         non_empty, x1, y1, x2, y2 = gimp.pdb.gimp_selection_bounds(self.image)
         if non_empty:
@@ -369,20 +1303,125 @@ class StableGimpfusionPlugin():
             data = layer.loadData(CONTROLNET_DEFAULT_SETTINGS)
             # ControlNet image size need to be in multiples of 64
             layer64 = layer.copy().insert().resizeToMultipleOf(64)
-            data.update({"input_image": layer64.toBase64()})
+            if numpy is not None and data["module"] in LOCAL_CONTROLNET_PREPROCESSORS:
+                detected = self.getLocalControlNetMap(layer64, data)
+                data.update({"input_image": detected.toBase64(), "module": "none"})
+                detected.remove()
+            else:
+                data.update({"input_image": layer64.toBase64()})
             if cn_layer.mask:
                 data.update({"mask": layer64.maskToBase64()})
             layer64.remove()
-            return data
+            return self.getControlNetDetectedParams(data)
         return None
 
-    def imageToImage(self, *args):
+    def applyDeadlinePlan(self, data):
+        """ Fit the request into the configured target latency using the measured backend throughput, returns the plan or None """
         global settings
-        resize_mode, prompt, negative_prompt, seed, batch_size, steps, mask_blur, width, height, cfg_scale, denoising_strength, sampler_index, cn1_enabled, cn1_layer, cn2_enabled, cn2_layer, cn_skip_annotator_layers = args
-        image = self.image
+        deadline = float(settings.get("target_seconds") or 0)
+        if deadline <= 0:
+            return None
+        model = LatencyStats().getThroughputModel(settings.get("sd_model_checkpoint") or "unknown", data.get("sampler_index"))
+        if model is None:
+            logging.info("Deadline planner needs a few measured generations with this checkpoint and sampler first")
+            return None
+        plan = planForDeadline(data, deadline, model)
+        data.update(dict((key, plan[key]) for key in ("steps", "width", "height", "batch_size")))
+        return plan
+
+    def getLocalControlNetMap(self, source, data):
+        """ Run the preprocessor of the unit on the source layer locally, returns the inserted map layer """
+        pixels = getPixels(source.layer, 0, 0, source.layer.width, source.layer.height)
+        detected = preprocessControlNetImage(data["module"], pixels, int(data["processor_res"]), data["threshold_a"], data["threshold_b"])
+        height, width = detected.shape[:2]
+        layer = Layer.create(self.image, data["module"] + " map", width, height, gimpenums.RGB_IMAGE, 100, gimpenums.NORMAL_MODE).insert()
+        setPixels(layer.layer, 0, 0, detected)
+        return layer
+
+    def previewControlNetMap(self, *args):
+        """ Insert the annotator map of the active ControlNet layer as a new layer, to check the preprocessor settings """
+        active_layer = self.image.active_layer
+        data = Layer(active_layer).loadData(CONTROLNET_DEFAULT_SETTINGS)
+        module = data["module"]
+        if module == "none":
+            self.showMessage("The active layer is not a ControlNet layer with a preprocessor module")
+            return
 
-        x, y, origWidth, origHeight = self.getSelectionBounds()
+        try:
+            gimp.pdb.gimp_progress_init("", None)
+            gimp.pdb.gimp_progress_set_text("Detecting " + module + " map...")
+
+            source = Layer(active_layer).copy().insert().resizeToMultipleOf(64)
+            if numpy is not None and module in LOCAL_CONTROLNET_PREPROCESSORS:
+                preview = self.getLocalControlNetMap(source, data)
+            else:
+                data.update({"input_image": source.toBase64()})
+                data = self.getControlNetDetectedParams(data)
+                if data["module"] != "none":
+                    raise Exception("The backend could not detect the " + module + " map")
+                preview = Layer.fromBase64(self.image, data["input_image"]).insert()
+            source.remove()
+            preview.rename(module + " map").resize(active_layer.width, active_layer.height).translate(active_layer.offsets)
+
+        except Exception as ex:
+            logging.exception("ERROR: StableGimpfusionPlugin.previewControlNetMap")
+            self.showMessage(repr(ex))
+        finally:
+            gimp.pdb.gimp_progress_end()
+            self.cleanup()
+
+    def getControlNetScripts(self, cn1_enabled, cn1_layer, cn2_enabled, cn2_layer, cn_skip_annotator_layers):
+        """ Payload fields for the enabled ControlNet units """
+        controlnet_units = []
+        if cn1_enabled:
+            controlnet_units.append(self.getControlNetParams(cn1_layer))
+        if cn2_enabled:
+            controlnet_units.append(self.getControlNetParams(cn2_layer))
+        if len(controlnet_units) == 0:
+            return {}
+
+        data = {
+            "alwayson_scripts": {
+                "controlnet": {
+                    "args": controlnet_units
+                }
+            }
+        }
+        if cn_skip_annotator_layers:
+            # ask the extension not to append the detected maps to the response at all
+            data.update({
+                "override_settings": {"control_net_no_detectmap": True},
+                "override_settings_restore_afterwards": True,
+            })
+        return data
 
+    def getControlNetDetectedParams(self, data):
+        """ Replace the input image with its (cached) annotator map, so the backend does not have to run the preprocessor on every generation """
+        if data["module"] not in CONTROLNET_DETECT_MODULES:
+            return data
+        cache = ControlNetDetectCache()
+        key = cache.key(data["input_image"], data)
+        detected = cache.get(key)
+        if detected is None:
+            gimp.pdb.gimp_progress_set_text("Detecting " + data["module"] + " map...")
+            response = self.api.post("/controlnet/detect", {
+                "controlnet_module": data["module"],
+                "controlnet_input_images": [data["input_image"]],
+                "controlnet_processor_res": data["processor_res"],
+                "controlnet_threshold_a": data["threshold_a"],
+                "controlnet_threshold_b": data["threshold_b"],
+            })
+            images = (response or {}).get("images") or []
+            if not images:
+                # let the backend run the preprocessor as part of the generation
+                return data
+            detected = str(images[0])
+            cache.set(key, detected)
+        data.update({"input_image": detected, "module": "none"})
+        return data
+
+    def getImageToImagePayload(self, resize_mode, prompt, negative_prompt, seed, batch_size, steps, mask_blur, width, height, cfg_scale, denoising_strength, sampler_index, cn1_enabled, cn1_layer, cn2_enabled, cn2_layer, cn_skip_annotator_layers):
+        global settings
         data = {
             "resize_mode": resize_mode,
             "init_images": [self.getActiveLayerAsBase64()],
@@ -399,26 +1438,25 @@ class StableGimpfusionPlugin():
             "seed": seed or -1
         }
 
+        data.update(self.getControlNetScripts(cn1_enabled, cn1_layer, cn2_enabled, cn2_layer, cn_skip_annotator_layers))
+        return data
+
+    def imageToImage(self, *args):
+        cn_skip_annotator_layers = args[-1]
+        image = self.image
+
+        x, y, origWidth, origHeight = self.getSelectionBounds()
+
         try:
             gimp.pdb.gimp_progress_init("", None)
             gimp.pdb.gimp_progress_set_text(random.choice(GENERATION_MESSAGES))
 
-            controlnet_units = []
-            if cn1_enabled:
-                controlnet_units.append(self.getControlNetParams(cn1_layer))
-            if cn2_enabled:
-                controlnet_units.append(self.getControlNetParams(cn2_layer))
-            if len(controlnet_units) > 0:
-                alwayson_scripts = {
-                    "controlnet": {
-                        "args": controlnet_units
-                    }
-                }
-                data.update({"alwayson_scripts": alwayson_scripts})
+            data = self.getImageToImagePayload(*args)
+            plan = self.applyDeadlinePlan(data)
+            response = self.postSharded("/sdapi/v1/img2img", data)
 
-            response = self.api.post("/sdapi/v1/img2img", data)
-
-            ResponseLayers(image, response, {"skip_annotator_layers": cn_skip_annotator_layers}).resize(origWidth, origHeight)
+            with ResponseLayers(image, response, {"skip_annotator_layers": cn_skip_annotator_layers, "plan": plan}) as layers:
+                layers.resize(origWidth, origHeight)
 
         except Exception as ex:
             logging.exception("ERROR: StableGimpfusionPlugin.imageToImage")
@@ -427,9 +1465,100 @@ class StableGimpfusionPlugin():
             gimp.pdb.gimp_progress_end()
             self.cleanup()
 
+    def loopback(self, *args):
+        """ Run image to image repeatedly, feeding every result straight into the next request.
+        Only the final result (and optionally the intermediate snapshots) is brought into Gimp. """
+        iterations, final_denoising_strength, keep_snapshots = args[-3:]
+        args = args[:-3]
+        cn_skip_annotator_layers = args[-1]
+        image = self.image
+
+        x, y, origWidth, origHeight = self.getSelectionBounds()
+        iterations = max(1, int(iterations))
+
+        try:
+            gimp.pdb.gimp_progress_init("", None)
+            gimp.pdb.gimp_progress_set_text(random.choice(GENERATION_MESSAGES))
+
+            data = self.getImageToImagePayload(*args)
+            data["batch_size"] = 1
+            first_denoising_strength = data["denoising_strength"]
+
+            response = None
+            for iteration in range(iterations):
+                if iterations > 1:
+                    progress = float(iteration) / (iterations - 1)
+                    data["denoising_strength"] = first_denoising_strength + (float(final_denoising_strength) - first_denoising_strength) * progress
+                gimp.pdb.gimp_progress_set_text("Loopback %d/%d, denoising strength %.2f" % (iteration + 1, iterations, data["denoising_strength"]))
+                gimp.pdb.gimp_progress_update(float(iteration) / iterations)
+
+                response = self.api.post("/sdapi/v1/img2img", data)
+                if response is None:
+                    raise Exception("Loopback iteration %d failed" % (iteration + 1))
+
+                if keep_snapshots and iteration < iterations - 1:
+                    with ResponseLayers(image, response, {"skip_annotator_layers": True}) as layers:
+                        layers.resize(origWidth, origHeight)
+
+                # the returned base64 image is the next init image as is, no round trip through Gimp
+                data["init_images"] = [response["images"][0]]
+                data["seed"] = json.loads(response["info"])["all_seeds"][0] + 1
+
+            with ResponseLayers(image, response, {"skip_annotator_layers": cn_skip_annotator_layers}) as layers:
+                layers.resize(origWidth, origHeight)
+
+        except Exception as ex:
+            logging.exception("ERROR: StableGimpfusionPlugin.loopback")
+            self.showMessage(repr(ex))
+        finally:
+            gimp.pdb.gimp_progress_end()
+            self.cleanup()
+
+    def getInpaintingRegion(self, layer, invert_mask, feather):
+        """ Bounding box (x, y, width, height) of what inpainting changes, grown by the feather radius,
+        and the feathered mask over it as a float array (None when NumPy is not available) """
+        image = self.image
+        non_empty, x1, y1, x2, y2 = gimp.pdb.gimp_selection_bounds(image)
+        if non_empty:
+            drawable = image.selection
+            offset_x, offset_y = 0, 0
+        elif layer.mask:
+            drawable = layer.mask
+            offset_x, offset_y = layer.offsets
+            x1, y1, x2, y2 = offset_x, offset_y, offset_x + layer.width, offset_y + layer.height
+            if numpy is not None and not invert_mask:
+                # the layer mask can be much smaller than the layer
+                rows, columns = numpy.nonzero(getPixels(drawable, 0, 0, layer.width, layer.height)[:, :, 0])
+                if len(rows) == 0:
+                    return None, None
+                x1, y1 = offset_x + columns.min(), offset_y + rows.min()
+                x2, y2 = offset_x + columns.max() + 1, offset_y + rows.max() + 1
+        else:
+            return None, None
+
+        if invert_mask:
+            x1, y1, x2, y2 = 0, 0, image.width, image.height
+        grow = 3 * int(feather)
+        x1, y1 = max(0, x1 - grow), max(0, y1 - grow)
+        x2, y2 = min(image.width, x2 + grow), min(image.height, y2 + grow)
+        region = (x1, y1, x2 - x1, y2 - y1)
+        if numpy is None:
+            return region, None
+
+        mask = numpy.zeros((y2 - y1, x2 - x1), dtype=numpy.float32)
+        # only the part of the region the mask drawable covers
+        dx1, dy1 = max(x1, offset_x), max(y1, offset_y)
+        dx2, dy2 = min(x2, offset_x + drawable.width), min(y2, offset_y + drawable.height)
+        if dx2 > dx1 and dy2 > dy1:
+            pixels = getPixels(drawable, dx1 - offset_x, dy1 - offset_y, dx2 - dx1, dy2 - dy1)
+            mask[dy1 - y1:dy2 - y1, dx1 - x1:dx2 - x1] = pixels[:, :, 0] / 255.0
+        if invert_mask:
+            mask = 1.0 - mask
+        return region, featherMask(mask, feather)
+
     def inpainting(self, *args):
         global settings
-        resize_mode, prompt, negative_prompt, seed, batch_size, steps, mask_blur, width, height, cfg_scale, denoising_strength, sampler_index, cn1_enabled, cn1_layer, cn2_enabled, cn2_layer, cn_skip_annotator_layers, invert_mask, inpaint_full_res = args
+        resize_mode, prompt, negative_prompt, seed, batch_size, steps, mask_blur, width, height, cfg_scale, denoising_strength, sampler_index, cn1_enabled, cn1_layer, cn2_enabled, cn2_layer, cn_skip_annotator_layers, invert_mask, inpaint_full_res, composite_in_place = args
         image = self.image
 
         x, y, origWidth, origHeight = self.getSelectionBounds()
@@ -442,6 +1571,7 @@ class StableGimpfusionPlugin():
 
         data = {
             "mask": mask,
+            "mask_blur": int(mask_blur),
             "inpaint_full_res": inpaint_full_res,
             "inpaint_full_res_padding": 10,
             "inpainting_mask_invert": 1 if invert_mask else 0,
@@ -465,23 +1595,23 @@ class StableGimpfusionPlugin():
             gimp.pdb.gimp_progress_init("", None)
             gimp.pdb.gimp_progress_set_text(random.choice(GENERATION_MESSAGES))
 
-            controlnet_units = []
-            if cn1_enabled:
-                controlnet_units.append(self.getControlNetParams(cn1_layer))
-            if cn2_enabled:
-                controlnet_units.append(self.getControlNetParams(cn2_layer))
-
-            if len(controlnet_units) > 0:
-                alwayson_scripts = {
-                    "controlnet": {
-                        "args": controlnet_units
-                    }
-                }
-                data.update({"alwayson_scripts": alwayson_scripts})
+            data.update(self.getControlNetScripts(cn1_enabled, cn1_layer, cn2_enabled, cn2_layer, cn_skip_annotator_layers))
+
+            region, region_mask = None, None
+            if composite_in_place:
+                region, region_mask = self.getInpaintingRegion(image.active_layer, invert_mask, mask_blur)
 
-            response = self.api.post("/sdapi/v1/img2img", data)
+            plan = self.applyDeadlinePlan(data)
+            response = self.postSharded("/sdapi/v1/img2img", data)
 
-            ResponseLayers(image, response, {"skip_annotator_layers": cn_skip_annotator_layers}).resize(self.image.width, self.image.height)
+            if region is not None:
+                # only keep the masked part of every result, blended in with the feathered mask
+                with ResponseLayers(image, response, {"skip_annotator_layers": cn_skip_annotator_layers, "region": region, "mask": region_mask, "plan": plan}) as layers:
+                    if region_mask is None and not invert_mask:
+                        layers.addSelectionAsMask()
+            else:
+                with ResponseLayers(image, response, {"skip_annotator_layers": cn_skip_annotator_layers, "plan": plan}) as layers:
+                    layers.resize(self.image.width, self.image.height)
 
         except Exception as ex:
             logging.exception("ERROR: StableGimpfusionPlugin.inpainting")
@@ -490,13 +1620,8 @@ class StableGimpfusionPlugin():
             gimp.pdb.gimp_progress_end()
             self.cleanup()
 
-    def textToImage(self, *args):
+    def getTextToImagePayload(self, prompt, negative_prompt, seed, batch_size, steps, mask_blur, width, height, cfg_scale, denoising_strength, sampler_index, cn1_enabled, cn1_layer, cn2_enabled, cn2_layer, cn_skip_annotator_layers):
         global settings
-        prompt, negative_prompt, seed, batch_size, steps, mask_blur, width, height, cfg_scale, denoising_strength, sampler_index, cn1_enabled, cn1_layer, cn2_enabled, cn2_layer, cn_skip_annotator_layers = args
-        image = self.image
-
-        x, y, origWidth, origHeight = self.getSelectionBounds()
-
         data = {
             "prompt": (prompt + " " + settings.get("prompt")).strip(),
             "negative_prompt": (negative_prompt + " " +  settings.get("negative_prompt")).strip(),
@@ -510,35 +1635,408 @@ class StableGimpfusionPlugin():
             "seed": seed or -1
         }
 
+        data.update(self.getControlNetScripts(cn1_enabled, cn1_layer, cn2_enabled, cn2_layer, cn_skip_annotator_layers))
+        return data
+
+    def textToImage(self, *args):
+        cn_skip_annotator_layers = args[-1]
+        image = self.image
+
+        x, y, origWidth, origHeight = self.getSelectionBounds()
+
         try:
             gimp.pdb.gimp_progress_init("", None)
             gimp.pdb.gimp_progress_set_text(random.choice(GENERATION_MESSAGES))
 
-            controlnet_units = []
-            if cn1_enabled:
-                controlnet_units.append(self.getControlNetParams(cn1_layer))
-            if cn2_enabled:
-                controlnet_units.append(self.getControlNetParams(cn2_layer))
-
-            if len(controlnet_units) > 0:
-                alwayson_scripts = {
-                    "controlnet": {
-                        "args": controlnet_units
-                    }
+            self.removeUnusedFitSelections()
+            data = self.getTextToImagePayload(*args)
+            # generate with the aspect ratio of the selection within the pixel budget of the width and height settings
+            data["width"], data["height"] = planResolution(origWidth, origHeight, int(data["width"]) * int(data["height"]))
+            plan = self.applyDeadlinePlan(data)
+            response = PrefetchCache().take("/sdapi/v1/txt2img", data)
+            if response is None:
+                response = self.postSharded("/sdapi/v1/txt2img", data)
+
+            # results stay at their native size until fitted, the selection is kept to mask them once they are, see fitResults
+            options = {"skip_annotator_layers": cn_skip_annotator_layers, "plan": plan, "target": [x, y, origWidth, origHeight]}
+            if x != 0 or y != 0 or origWidth != image.width or origHeight != image.height:
+                channel = gimp.pdb.gimp_selection_save(image)
+                options["selection"] = FIT_SELECTION_CHANNEL_PREFIX + str(uuid.uuid4())
+                gimp.pdb.gimp_item_set_name(channel, options["selection"])
+            with ResponseLayers(image, response, options) as layers:
+                layers.translate((x, y))
+            self.prefetch("/sdapi/v1/txt2img", data, response)
+
+        except Exception as ex:
+            logging.exception("ERROR: StableGimpfusionPlugin.textToImage")
+            self.showMessage(repr(ex))
+        finally:
+            gimp.pdb.gimp_progress_end()
+            self.cleanup()
+
+    def postSharded(self, endpoint, data):
+        """ POST a generation request, with its batch split across the extra backends if there are any.
+        Only backends with the same checkpoint loaded take part, otherwise the results would differ from a single run. """
+        backends = getShardBackends()
+        if not backends or data.get("batch_size", 1) < 2 or data.get("n_iter", 1) != 1:
+            return self.api.post(endpoint, data)
+        checkpoint = (self.api.get("/sdapi/v1/options") or {}).get("sd_model_checkpoint")
+        clients = [self.api]
+        for url in backends:
+            client = ApiClient(url)
+            backend_checkpoint = (client.get("/sdapi/v1/options") or {}).get("sd_model_checkpoint")
+            if checkpoint is None or backend_checkpoint != checkpoint:
+                logging.warning("Not sharding to %s, it has %s loaded instead of %s", url, backend_checkpoint, checkpoint)
+                continue
+            clients.append(client)
+        if len(clients) == 1:
+            return self.api.post(endpoint, data)
+        payloads = shardPayload(data, len(clients))
+        responses = post_concurrently([(client, endpoint, payload) for client, payload in zip(clients, payloads)])
+        if None in responses:
+            raise Exception("A sub-batch of the request failed, see the log for details")
+        return mergeResponses(responses)
+
+    def prefetch(self, endpoint, data, response):
+        """ Have the next seeds of a random seed payload generated in the background, if enabled in the config """
+        global settings
+        count = int(settings.get("prefetch_count") or 0)
+        if count <= 0 or response is None or data.get("seed", -1) != -1:
+            return
+        try:
+            seeds = json.loads(response["info"])["all_seeds"]
+            PrefetchCache().schedule(settings.get("api_base"), endpoint, data, max(seeds) + 1, count)
+        except Exception as ex:
+            logging.exception("ERROR: StableGimpfusionPlugin.prefetch")
+
+    def submitTextToImage(self, *args):
+        """ Hand a text to image job over to a background worker and return right away, see collectResults """
+        global settings
+        cn_skip_annotator_layers = args[-1]
+        image = self.image
+
+        x, y, origWidth, origHeight = self.getSelectionBounds()
+
+        try:
+            gimp.pdb.gimp_progress_init("", None)
+            gimp.pdb.gimp_progress_set_text("Submitting job...")
+
+            data = self.getTextToImagePayload(*args)
+            target = {
+                "image": image.ID,
+                "filename": image.filename,
+                "bounds": [x, y, origWidth, origHeight],
+                "skip_annotator_layers": cn_skip_annotator_layers,
+            }
+            job_id = BackgroundJobs().submit(settings.get("api_base"), "/sdapi/v1/txt2img", data, target)
+            if x != 0 or y != 0 or origWidth != image.width or origHeight != image.height:
+                # keep the selection around so the results can be masked with it once collected
+                channel = gimp.pdb.gimp_selection_save(image)
+                gimp.pdb.gimp_item_set_name(channel, BACKGROUND_JOB_CHANNEL_PREFIX + job_id)
+
+        except Exception as ex:
+            logging.exception("ERROR: StableGimpfusionPlugin.submitTextToImage")
+            self.showMessage(repr(ex))
+        finally:
+            gimp.pdb.gimp_progress_end()
+            self.cleanup()
+
+    def collectResults(self, *args):
+        """ Insert the results of finished background jobs that were submitted from this image """
+        image = self.image
+        jobs = BackgroundJobs()
+        collected = 0
+        failed = 0
+        pending = 0
+        for job_id in jobs.list():
+            job = jobs.load(job_id)
+            if job is None:
+                continue
+            # image IDs do not survive a Gimp restart, saved images can still be matched by their file
+            if job["target"]["image"] != image.ID and (not image.filename or job["target"]["filename"] != image.filename):
+                continue
+            state, result = jobs.result(job_id)
+            if state == "pending":
+                if jobs.isWorkerAlive(job_id) or time.time() - job["submitted"] < WORKER_HEARTBEAT_TIMEOUT:
+                    pending += 1
+                    continue
+                # the worker is gone, unless it finished just now it never will
+                state, result = jobs.result(job_id)
+                if state == "pending":
+                    state, result = "failed", "The worker stopped without a result, see " + jobs.jobPath(job_id, "worker.log")
+
+            channel = gimp.pdb.gimp_image_get_channel_by_name(image, BACKGROUND_JOB_CHANNEL_PREFIX + job_id)
+            try:
+                if state == "done":
+                    target = job["target"]
+                    x, y, width, height = target["bounds"]
+                    with ResponseLayers(image, result, {"skip_annotator_layers": target["skip_annotator_layers"]}) as layers:
+                        layers.resize(width, height).translate((x, y))
+                        if channel is not None:
+                            self.addChannelAsMask(layers, channel)
+                    collected += 1
+                else:
+                    logging.error("Background job %s failed: %s", job_id, result)
+                    failed += 1
+            except Exception as ex:
+                logging.exception("ERROR: StableGimpfusionPlugin.collectResults")
+                failed += 1
+            if channel is not None:
+                gimp.pdb.gimp_image_remove_channel(image, channel)
+            jobs.remove(job_id)
+
+        self.showMessage("Collected %d finished jobs, %d failed, %d still running" % (collected, failed, pending))
+
+    def getSavedRegions(self, include_paths):
+        """ (name, item) for every saved selection channel and optionally every path of the image """
+        regions = []
+        for channel in self.image.channels:
+            if not channel.name.startswith(BACKGROUND_JOB_CHANNEL_PREFIX) and not channel.name.startswith(FIT_SELECTION_CHANNEL_PREFIX):
+                regions.append((channel.name, channel))
+        if include_paths:
+            for vectors in self.image.vectors:
+                regions.append((vectors.name, vectors))
+        return regions
+
+    def regionInpainting(self, *args):
+        """ Inpaint every saved selection channel (and path) at once, each cropped to its own region and prompted with its name """
+        global settings
+        prompt, negative_prompt, seed, steps, mask_blur, cfg_scale, denoising_strength, sampler_index, padding, include_paths = args
+        image = self.image
+
+        regions = self.getSavedRegions(include_paths)
+        if not regions:
+            self.showMessage("Save the areas to inpaint as channels (Select > Save to Channel) and name them after what they should contain")
+            return
+
+        saved_selection = None
+        try:
+            gimp.pdb.gimp_progress_init("", None)
+            gimp.pdb.gimp_progress_set_text(random.choice(GENERATION_MESSAGES))
+
+            if not gimp.pdb.gimp_selection_is_empty(image):
+                saved_selection = gimp.pdb.gimp_selection_save(image)
+
+            source = image.active_layer
+            padding = int(padding)
+            jobs = []
+            targets = []
+            for name, item in regions:
+                gimp.pdb.gimp_image_select_item(image, gimpenums.CHANNEL_OP_REPLACE, item)
+                non_empty, x1, y1, x2, y2 = gimp.pdb.gimp_selection_bounds(image)
+                if not non_empty:
+                    continue
+                x1, y1 = max(0, x1 - padding), max(0, y1 - padding)
+                x2, y2 = min(image.width, x2 + padding), min(image.height, y2 + padding)
+                region = (x1, y1, x2 - x1, y2 - y1)
+                generation_width, generation_height = self.getGenerationSize(region[2], region[3])
+
+                # default channel names are not much of a prompt
+                region_prompt = "" if name.startswith("Selection Mask") else name
+                data = {
+                    "init_images": [self.getRegionAsBase64(source, *region)],
+                    "mask": self.getRegionMaskAsBase64(*region),
+                    "mask_blur": int(mask_blur),
+                    "inpainting_fill": 1,
+                    "inpaint_full_res": False,
+                    "inpainting_mask_invert": 0,
+
+                    "prompt": (region_prompt + " " + prompt + " " + settings.get("prompt")).strip(),
+                    "negative_prompt": (negative_prompt + " " +  settings.get("negative_prompt")).strip(),
+                    "denoising_strength": float(denoising_strength),
+                    "steps": int(steps),
+                    "cfg_scale": float(cfg_scale),
+                    "width": generation_width,
+                    "height": generation_height,
+                    "sampler_index": SAMPLERS[sampler_index],
+                    "batch_size": 1,
+                    "seed": seed or -1
                 }
-                data.update({"alwayson_scripts": alwayson_scripts})
+                jobs.append((self.api, "/sdapi/v1/img2img", data))
+                targets.append((name, item, region))
+            gimp.pdb.gimp_image_set_active_layer(image, source)
 
-            response = self.api.post("/sdapi/v1/txt2img", data)
+            responses = post_concurrently(jobs)
 
-            ResponseLayers(image, response, {"skip_annotator_layers": cn_skip_annotator_layers}).resize(origWidth, origHeight).translate((x, y)).addSelectionAsMask()
+            for (name, item, region), response in zip(targets, responses):
+                if response is None:
+                    logging.error("Inpainting region %s failed", name)
+                    continue
+                x, y, width, height = region
+                gimp.pdb.gimp_image_select_item(image, gimpenums.CHANNEL_OP_REPLACE, item)
+                with ResponseLayers(image, response) as layers:
+                    layers.resize(width, height).translate((x, y)).addSelectionAsMask()
 
         except Exception as ex:
-            logging.exception("ERROR: StableGimpfusionPlugin.textToImage")
+            logging.exception("ERROR: StableGimpfusionPlugin.regionInpainting")
             self.showMessage(repr(ex))
         finally:
+            if saved_selection is not None:
+                gimp.pdb.gimp_image_select_item(image, gimpenums.CHANNEL_OP_REPLACE, saved_selection)
+                gimp.pdb.gimp_image_remove_channel(image, saved_selection)
+            else:
+                gimp.pdb.gimp_selection_none(image)
             gimp.pdb.gimp_progress_end()
             self.cleanup()
 
+    def outpainting(self, *args):
+        """ Extend the canvas and generate only the new border strips, each with a bit of the original as context """
+        global settings
+        prompt, negative_prompt, seed, steps, mask_blur, cfg_scale, denoising_strength, sampler_index, new_width, new_height, anchor, context_margin = args
+        image = self.image
+
+        old_width, old_height = image.width, image.height
+        new_width = max(old_width, int(new_width))
+        new_height = max(old_height, int(new_height))
+        if new_width == old_width and new_height == old_height:
+            self.showMessage("The new canvas size must be larger than the current one")
+            return
+
+        anchor_name, fx, fy = OUTPAINTING_ANCHORS[anchor]
+        offset_x = int((new_width - old_width) * fx)
+        offset_y = int((new_height - old_height) * fy)
+
+        saved_selection = None
+        visible = None
+        try:
+            gimp.pdb.gimp_progress_init("", None)
+            gimp.pdb.gimp_progress_set_text(random.choice(GENERATION_MESSAGES))
+
+            if not gimp.pdb.gimp_selection_is_empty(image):
+                saved_selection = gimp.pdb.gimp_selection_save(image)
+            gimp.pdb.gimp_image_resize(image, new_width, new_height, offset_x, offset_y)
+
+            strips = getOutpaintingStrips(offset_x, offset_y, old_width, old_height, new_width, new_height, int(context_margin))
+
+            # flatten what is visible once, every strip crops its context out of it
+            active_layer = image.active_layer
+            visible = Layer(gimp.pdb.gimp_layer_new_from_visible(image, image, "outpainting")).insert()
+
+            jobs = []
+            for name, region, new_area in strips:
+                x, y, width, height = region
+                generation_width, generation_height = self.getGenerationSize(width, height)
+                gimp.pdb.gimp_image_select_rectangle(image, gimpenums.CHANNEL_OP_REPLACE, *new_area)
+                data = {
+                    "init_images": [self.getRegionAsBase64(visible.layer, x, y, width, height)],
+                    "mask": self.getRegionMaskAsBase64(x, y, width, height),
+                    "mask_blur": int(mask_blur),
+                    "inpainting_fill": 2,
+                    "inpaint_full_res": False,
+                    "inpainting_mask_invert": 0,
+
+                    "prompt": (prompt + " " + settings.get("prompt")).strip(),
+                    "negative_prompt": (negative_prompt + " " +  settings.get("negative_prompt")).strip(),
+                    "denoising_strength": float(denoising_strength),
+                    "steps": int(steps),
+                    "cfg_scale": float(cfg_scale),
+                    "width": generation_width,
+                    "height": generation_height,
+                    "sampler_index": SAMPLERS[sampler_index],
+                    "batch_size": 1,
+                    "seed": seed or -1
+                }
+                jobs.append((self.api, "/sdapi/v1/img2img", data))
+
+            visible.remove()
+            visible = None
+            gimp.pdb.gimp_image_set_active_layer(image, active_layer)
+
+            responses = post_concurrently(jobs)
+
+            for (name, region, new_area), response in zip(strips, responses):
+                if response is None:
+                    logging.error("Outpainting the %s strip failed", name)
+                    continue
+                x, y, width, height = region
+                with ResponseLayers(image, response) as layers:
+                    layers.resize(width, height).translate((x, y))
+                    if numpy is not None:
+                        layers.multiplyAlpha(getBorderMask(region, new_area, mask_blur))
+                    else:
+                        gimp.pdb.gimp_image_select_rectangle(image, gimpenums.CHANNEL_OP_REPLACE, *new_area)
+                        layers.addSelectionAsMask()
+
+        except Exception as ex:
+            logging.exception("ERROR: StableGimpfusionPlugin.outpainting")
+            self.showMessage(repr(ex))
+        finally:
+            if visible is not None:
+                visible.remove()
+            if saved_selection is not None:
+                gimp.pdb.gimp_image_select_item(image, gimpenums.CHANNEL_OP_REPLACE, saved_selection)
+                gimp.pdb.gimp_image_remove_channel(image, saved_selection)
+            else:
+                gimp.pdb.gimp_selection_none(image)
+            gimp.pdb.gimp_progress_end()
+            self.cleanup()
+
+    def getGenerationSize(self, width, height):
+        """ Size to generate a width x height area at: its own size within the pixel budget of the width and height
+        settings, planned into that budget otherwise, and never below 64 pixels on a side """
+        global settings
+        budget = int(settings.get("width")) * int(settings.get("height"))
+        if width * height > budget:
+            return planResolution(width, height, budget)
+        return max(64, int(roundToMultiple(width, 8))), max(64, int(roundToMultiple(height, 8)))
+
+    def fitResults(self, *args):
+        """ Scale results to the selection they were generated for. Applies to the active layer,
+        or to the visible layers if a result group is active, so discarded results are never resampled. """
+        active_layer = self.image.active_layer
+        if gimp.pdb.gimp_item_is_group(active_layer):
+            layers = [layer for layer in active_layer.children if gimp.pdb.gimp_item_get_visible(layer)]
+        else:
+            layers = [active_layer]
+
+        fitted = 0
+        gimp.pdb.gimp_image_undo_group_start(self.image)
+        try:
+            for layer in layers:
+                layer = Layer(layer)
+                data = layer.loadData({})
+                if data.get("target") is None:
+                    continue
+                layer.fitTo(*data.pop("target"))
+                selection = data.pop("selection", None)
+                channel = gimp.pdb.gimp_image_get_channel_by_name(self.image, selection) if selection else None
+                if channel is not None:
+                    self.addChannelAsMask(layer, channel)
+                layer.saveData(data)
+                fitted += 1
+            self.removeUnusedFitSelections()
+        except Exception as ex:
+            logging.exception("ERROR: StableGimpfusionPlugin.fitResults")
+            self.showMessage(repr(ex))
+        finally:
+            gimp.pdb.gimp_image_undo_group_end(self.image)
+            gimp.displays_flush()
+        if not fitted:
+            self.showMessage("There are no results to fit, select a generated layer or its group")
+
+    def removeUnusedFitSelections(self):
+        """ Drop the saved selections no unfitted result refers to anymore, because the results were fitted or deleted """
+        used = set()
+        pending = list(self.image.layers)
+        while pending:
+            layer = pending.pop()
+            if gimp.pdb.gimp_item_is_group(layer):
+                pending += layer.children
+            else:
+                used.add(Layer(layer).loadData({}).get("selection"))
+        for channel in self.image.channels:
+            if channel.name.startswith(FIT_SELECTION_CHANNEL_PREFIX) and channel.name not in used:
+                gimp.pdb.gimp_image_remove_channel(self.image, channel)
+
+    def addChannelAsMask(self, target, channel):
+        """ Mask a Layer or ResponseLayers with a saved selection channel, keeping the current selection """
+        saved_selection = gimp.pdb.gimp_selection_save(self.image)
+        gimp.pdb.gimp_image_select_item(self.image, gimpenums.CHANNEL_OP_REPLACE, channel)
+        target.addSelectionAsMask()
+        gimp.pdb.gimp_image_select_item(self.image, gimpenums.CHANNEL_OP_REPLACE, saved_selection)
+        gimp.pdb.gimp_image_remove_channel(self.image, saved_selection)
+        return target
+
     def showLayerInfo(self, *args):
         """ Show any layer info associated with the active layer """
 
@@ -569,12 +2067,20 @@ class StableGimpfusionPlugin():
         cnlayer.saveData(cn_settings)
         cnlayer.rename("ControlNet"+str(cnlayer.id))
 
-    def config(self, prompt, negative_prompt, url):
+    def showPerformanceReport(self, *args):
+        """ Show latency percentiles and average request/response sizes of past generations """
+        report = LatencyStats().report()
+        gimp.pdb.gimp_message("Generation latency per dimension\n\n" + (report or "No generations recorded yet"))
+
+    def config(self, prompt, negative_prompt, url, target_seconds, prefetch_count, shard_backends):
         global settings
         settings.save({
             "prompt": prompt,
             "negative_prompt": negative_prompt,
             "api_base": url,
+            "target_seconds": target_seconds,
+            "prefetch_count": prefetch_count,
+            "shard_backends": shard_backends,
         })
 
     def changeModel(self, model):
@@ -597,11 +2103,15 @@ class TempFiles(object):
         return cls.instance
 
     def __init__(self):
-        self.files = []
+        if not hasattr(self, "files"):
+            self.files = []
 
     def get(self, filename):
-        self.files.append(filename)
-        return r"{}".format(os.path.join(tempfile.gettempdir(), filename))
+        """ A path in the temp directory, prefixed with the process id: layer ids restart in every plug-in process,
+        and the files are streamed long after they are saved, so concurrent runs must not share them """
+        filepath = os.path.join(tempfile.gettempdir(), "stable_gimpfusion_%d_%s" % (os.getpid(), filename))
+        self.files.append(filepath)
+        return filepath
 
     def removeAll(self):
         try:
@@ -609,10 +2119,341 @@ class TempFiles(object):
             for tmpfile in unique_list:
                 if os.path.exists(tmpfile):
                     os.remove(tmpfile)
+            self.files = []
         except Exception as ex:
             ex = ex
 
 
+class BackgroundJobs():
+    """ Jobs handed over to a worker process, one directory per job holding the payload, its images and eventually the response """
+    def __init__(self):
+        self.path = os.path.join(tempfile.gettempdir(), "stable_gimpfusion_jobs")
+
+    def jobPath(self, job_id, filename=""):
+        return os.path.join(self.path, job_id, filename)
+
+    def externalize(self, data, job_path, files):
+        """ Copy Base64File images next to the payload, they are streamed again by the worker """
+        if isinstance(data, Base64File):
+            filename = "image%d.png" % len(files)
+            shutil.copyfile(data.filepath, os.path.join(job_path, filename))
+            files.append(filename)
+            return {"$file": filename}
+        if isinstance(data, dict):
+            return dict((key, self.externalize(value, job_path, files)) for key, value in data.items())
+        if isinstance(data, (list, tuple)):
+            return [self.externalize(value, job_path, files) for value in data]
+        return data
+
+    def internalize(self, data, job_path):
+        if isinstance(data, dict):
+            if "$file" in data:
+                return Base64File(os.path.join(job_path, data["$file"]))
+            return dict((str(key), self.internalize(value, job_path)) for key, value in data.items())
+        if isinstance(data, list):
+            return [self.internalize(value, job_path) for value in data]
+        return data
+
+    def submit(self, api_base, endpoint, data, target):
+        job_id = uuid.uuid4().hex[:12]
+        job_path = self.jobPath(job_id)
+        os.makedirs(job_path)
+        job = {
+            "api_base": api_base,
+            "endpoint": endpoint,
+            "payload": self.externalize(data, job_path, []),
+            "target": target,
+            "submitted": time.time(),
+        }
+        with open(self.jobPath(job_id, "job.json"), "w") as f:
+            json.dump(job, f)
+        self.spawn("worker", job_id)
+        return job_id
+
+    def spawn(self, command, job_id):
+        """ Start the plugin file as a command line tool working on the job, detached from Gimp """
+        with open(self.jobPath(job_id, "worker.log"), "w") as log, open(os.devnull, "r") as devnull:
+            subprocess.Popen([sys.executable, os.path.realpath(__file__), command, self.jobPath(job_id)],
+                    stdin=devnull, stdout=log, stderr=log, close_fds=(os.name != "nt"))
+
+    def isWorkerAlive(self, job_id):
+        filepath = self.jobPath(job_id, "heartbeat")
+        return os.path.isfile(filepath) and time.time() - os.path.getmtime(filepath) < WORKER_HEARTBEAT_TIMEOUT
+
+    def heartbeat(self, job_id):
+        """ Keep the heartbeat file of the job fresh from a daemon thread while the worker waits for the backend,
+        returns the event that stops it """
+        stopped = threading.Event()
+        def beat():
+            try:
+                while not stopped.is_set():
+                    with open(self.jobPath(job_id, "heartbeat"), "w") as f:
+                        f.write(str(time.time()))
+                    stopped.wait(WORKER_HEARTBEAT_TIMEOUT / 3.0)
+            except Exception as ex:
+                # the job was removed
+                logging.debug(ex)
+        thread = threading.Thread(target=beat)
+        thread.daemon = True
+        thread.start()
+        return stopped
+
+    def list(self):
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(os.listdir(self.path))
+
+    def load(self, job_id):
+        try:
+            with open(self.jobPath(job_id, "job.json"), "r") as f:
+                return deunicodeDict(json.load(f))
+        except Exception as ex:
+            logging.debug(ex)
+            return None
+
+    def result(self, job_id):
+        """ Returns ("done", response), ("failed", error) or ("pending", None) """
+        for state in ("done", "failed"):
+            filepath = self.jobPath(job_id, state + ".json")
+            if os.path.isfile(filepath):
+                with open(filepath, "r") as f:
+                    return state, json.load(f)
+        return "pending", None
+
+    def finish(self, job_id, state, result):
+        """ Written by the worker, the rename makes the result appear atomically """
+        filepath = self.jobPath(job_id, state + ".json")
+        with open(filepath + ".tmp", "w") as f:
+            json.dump(result, f)
+        os.rename(filepath + ".tmp", filepath)
+
+    def remove(self, job_id):
+        shutil.rmtree(self.jobPath(job_id), True)
+
+    def run(self, job_path):
+        """ Worker process entry point """
+        job_path = os.path.normpath(job_path)
+        self.path = os.path.dirname(job_path)
+        job_id = os.path.basename(job_path)
+        self.heartbeat(job_id)
+        try:
+            job = self.load(job_id)
+            if job is None:
+                raise Exception("Could not load the job from " + job_path)
+            client = ApiClient(job["api_base"])
+            client.priority = "bulk"
+            response = client.post(job["endpoint"], self.internalize(job["payload"], self.jobPath(job_id)))
+            if response is None:
+                self.finish(job_id, "failed", "Request to %s%s failed, see worker.log" % (job["api_base"], job["endpoint"]))
+                return 1
+            self.finish(job_id, "done", response)
+            return 0
+        except Exception as ex:
+            logging.exception("ERROR: BackgroundJobs.run")
+            self.finish(job_id, "failed", repr(ex))
+            return 1
+
+
+class PrefetchCache(BackgroundJobs):
+    """ Results generated ahead of time for the next seeds of a payload, one job directory per payload.
+    A worker process keeps a few batches ready while the backend is idle and exits when nobody asks for more. """
+    def __init__(self):
+        self.path = os.path.join(tempfile.gettempdir(), "stable_gimpfusion_prefetch")
+
+    def key(self, endpoint, data):
+        """ Payloads that only differ in the seed share their prefetched results, as long as the backend and checkpoint are the same """
+        shelf = settings or MyShelf(STABLE_GIMPFUSION_DEFAULT_SETTINGS)
+        digest = hashlib.sha1(json.dumps([endpoint, shelf.get("api_base"), shelf.get("sd_model_checkpoint")]))
+        for piece in iterjson(dict((key, value) for key, value in data.items() if key != "seed")):
+            digest.update(piece)
+        return digest.hexdigest()
+
+    def entries(self, key):
+        if not os.path.isdir(self.jobPath(key)):
+            return []
+        return sorted([name for name in os.listdir(self.jobPath(key)) if name.endswith(".result")], key=lambda name: int(name.split(".")[0]))
+
+    def take(self, endpoint, data):
+        """ Pop the oldest prefetched response for a random seed payload, None if there is none """
+        if data.get("seed", -1) != -1:
+            return None
+        key = self.key(endpoint, data)
+        for name in self.entries(key):
+            filepath = self.jobPath(key, name)
+            try:
+                # renaming first makes sure the worker and another Gimp call can not take it too
+                os.rename(filepath, filepath + ".taken")
+                with open(filepath + ".taken", "r") as f:
+                    response = json.load(f)
+                os.remove(filepath + ".taken")
+                return response
+            except Exception as ex:
+                logging.debug(ex)
+        return None
+
+    def schedule(self, api_base, endpoint, data, next_seed, count):
+        """ Make sure a worker keeps about `count` images for the payload ready, starting at next_seed """
+        key = self.key(endpoint, data)
+        job_path = self.jobPath(key)
+        if self.isWorkerAlive(key):
+            os.utime(self.jobPath(key, "job.json"), None)
+            return
+        # the key covers the payload, so whatever an earlier worker prefetched for it is still good
+        job = self.load(key)
+        if job is None:
+            self.remove(key)
+            os.makedirs(job_path)
+            job = {
+                "api_base": api_base,
+                "endpoint": endpoint,
+                "payload": self.externalize(data, job_path, []),
+            }
+        entries = self.entries(key)
+        if entries:
+            try:
+                with open(self.jobPath(key, entries[-1]), "r") as f:
+                    next_seed = max(next_seed, max(json.loads(json.load(f)["info"])["all_seeds"]) + 1)
+            except Exception as ex:
+                logging.debug(ex)
+        job.update({
+            "next_seed": next_seed,
+            "batches": max(1, int(math.ceil(float(count) / data.get("batch_size", 1)))),
+        })
+        filepath = self.jobPath(key, "job.json")
+        with open(filepath + ".tmp", "w") as f:
+            json.dump(job, f)
+        os.rename(filepath + ".tmp", filepath)
+        self.prune(key)
+        self.spawn("prefetch", key)
+
+    def prune(self, keep):
+        """ Keep the cache bounded to the most recently used payloads, the workers of removed ones stop by themselves """
+        keys = [key for key in self.list() if key != keep and os.path.isfile(self.jobPath(key, "job.json"))]
+        keys.sort(key=lambda key: os.path.getmtime(self.jobPath(key, "job.json")), reverse=True)
+        for key in keys[PREFETCH_MAX_PAYLOADS - 1:]:
+            self.remove(key)
+
+    def acquireWorker(self, key):
+        """ Make sure only one worker runs per payload: the heartbeat file is created exclusively,
+        a stale one left by a crashed worker is taken over. Returns False if another worker is alive. """
+        filepath = self.jobPath(key, "heartbeat")
+        for attempt in range(2):
+            try:
+                os.close(os.open(filepath, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return True
+            except OSError:
+                if self.isWorkerAlive(key):
+                    return False
+                # renaming lets only one of several starting workers take the stale file over
+                stale_path = "%s.%d.stale" % (filepath, os.getpid())
+                try:
+                    os.rename(filepath, stale_path)
+                except OSError:
+                    return False
+                fresh = time.time() - os.path.getmtime(stale_path) < WORKER_HEARTBEAT_TIMEOUT
+                os.remove(stale_path)
+                if fresh:
+                    return False
+        return False
+
+    def isBackendIdle(self, client):
+        progress = client.get("/sdapi/v1/progress", {"skip_current_image": "true"})
+        return progress is not None and progress.get("state", {}).get("job_count", 0) == 0
+
+    def run(self, job_path):
+        """ Prefetch worker entry point. Images are generated one at a time, and only while the backend
+        has nothing else to do, so a real job never waits for more than a single prefetched image. """
+        job_path = os.path.normpath(job_path)
+        self.path = os.path.dirname(job_path)
+        key = os.path.basename(job_path)
+        if not self.acquireWorker(key):
+            return 0
+        # the heartbeat also covers the time a request spends in the backend or a queue server
+        stopped = self.heartbeat(key)
+        try:
+            job = self.load(key)
+            client = ApiClient(job["api_base"])
+            client.priority = "bulk"
+            payload = self.internalize(job["payload"], job_path)
+            batch_size = payload.get("batch_size", 1)
+            seed = job["next_seed"]
+            # continue after the results an earlier worker left behind
+            counter = max([int(name.split(".")[0]) for name in self.entries(key)] + [-1]) + 1
+            pending = []
+            last_activity = time.time()
+            while os.path.isfile(self.jobPath(key, "job.json")) and time.time() - last_activity < PREFETCH_IDLE_TIMEOUT:
+                if len(self.entries(key)) >= job["batches"] or not self.isBackendIdle(client):
+                    time.sleep(1)
+                    continue
+                response = client.post(job["endpoint"], dict(payload, seed=seed, batch_size=1))
+                if response is None:
+                    return 1
+                seed += 1
+                pending.append(response)
+                if len(pending) == batch_size:
+                    filepath = self.jobPath(key, "%d.result" % counter)
+                    with open(filepath + ".tmp", "w") as f:
+                        json.dump(mergeResponses(pending), f)
+                    os.rename(filepath + ".tmp", filepath)
+                    counter += 1
+                    pending = []
+                    last_activity = time.time()
+            return 0
+        finally:
+            # the next schedule starts a new worker right away
+            stopped.set()
+            try:
+                os.remove(self.jobPath(key, "heartbeat"))
+            except OSError as ex:
+                logging.debug(ex)
+
+
+class ControlNetDetectCache():
+    """ Disk cache of annotator maps returned by /controlnet/detect, keyed by the layer content and preprocessor settings """
+    def __init__(self):
+        self.path = os.path.join(tempfile.gettempdir(), "stable_gimpfusion_detect_cache")
+
+    def key(self, input_image, data):
+        digest = hashlib.sha1()
+        if isinstance(input_image, Base64File):
+            input_image.hash(digest)
+        else:
+            digest.update(input_image)
+        for name in ("module", "processor_res", "threshold_a", "threshold_b"):
+            digest.update("|%s=%s" % (name, data.get(name)))
+        return digest.hexdigest()
+
+    def get(self, key):
+        filepath = os.path.join(self.path, key)
+        try:
+            if os.path.isfile(filepath):
+                with open(filepath, "rb") as f:
+                    result = f.read()
+                # mark as recently used
+                os.utime(filepath, None)
+                return result
+        except Exception as e:
+            logging.debug(e)
+        return None
+
+    def set(self, key, value):
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            with open(os.path.join(self.path, key), "wb") as f:
+                f.write(value)
+            self.prune()
+        except Exception as e:
+            logging.debug(e)
+
+    def prune(self, max_entries=CONTROLNET_DETECT_CACHE_SIZE):
+        """ Drop the least recently used maps """
+        entries = [os.path.join(self.path, name) for name in os.listdir(self.path)]
+        entries.sort(key=os.path.getmtime, reverse=True)
+        for filepath in entries[max_entries:]:
+            os.remove(filepath)
+
+
 class LayerData():
     def __init__(self, layer, defaults = {}):
         self.name = 'gimpfusion'
@@ -683,6 +2524,7 @@ class Layer():
     def resize(self, width, height):
         logging.info("Resizing to %dx%d", width, height)
         gimp.pdb.gimp_layer_scale(self.layer, width, height, False)
+        return self
 
     def resizeToMultipleOf(self, multiple):
         gimp.pdb.gimp_layer_scale(self.layer, roundToMultiple(self.layer.width, multiple), roundToMultiple(self.layer.height, multiple), False)
@@ -693,13 +2535,19 @@ class Layer():
             gimp.pdb.gimp_layer_set_offsets(self.layer, offset[0], offset[1])
         return self
 
+    def crop(self, x, y, width, height):
+        """ Crop the layer to the (x, y, width, height) rect, given in image coordinates """
+        offset_x, offset_y = self.layer.offsets
+        gimp.pdb.gimp_layer_resize(self.layer, width, height, offset_x - x, offset_y - y)
+        return self
+
     def insert(self):
         gimp.pdb.gimp_image_insert_layer(self.image, self.layer, None, -1)
         return self
 
-    def insertTo(self, image=None):
+    def insertTo(self, image=None, parent=None, position=-1):
         image = image or self.image
-        gimp.pdb.gimp_image_insert_layer(image, self.layer, None, -1)
+        gimp.pdb.gimp_image_insert_layer(image, self.layer, parent, position)
         return self
 
     def addSelectionAsMask(self):
@@ -707,6 +2555,35 @@ class Layer():
         self.layer.add_mask(mask)
         return self
 
+    def fitTo(self, x, y, width, height):
+        """ Scale the layer to cover the (x, y, width, height) rect, given in image coordinates, without distorting it
+        and crop what sticks out """
+        scale = max(float(width) / self.layer.width, float(height) / self.layer.height)
+        scaled_width = max(width, int(round(self.layer.width * scale)))
+        scaled_height = max(height, int(round(self.layer.height * scale)))
+        gimp.pdb.gimp_layer_scale(self.layer, scaled_width, scaled_height, False)
+        self.translate((x - (scaled_width - width) // 2, y - (scaled_height - height) // 2))
+        return self.crop(x, y, width, height)
+
+    def cropToRegion(self, region, canvas_width, canvas_height):
+        """ Cut the region, given in canvas coordinates, out of a layer covering the whole canvas at a different resolution
+        and scale it to the region size. Cropping first means only the region gets scaled. """
+        x, y, width, height = region
+        scale_x = float(self.layer.width) / canvas_width
+        scale_y = float(self.layer.height) / canvas_height
+        self.crop(int(x * scale_x), int(y * scale_y), max(1, int(round(width * scale_x))), max(1, int(round(height * scale_y))))
+        self.resize(width, height)
+        return self.translate((x, y))
+
+    def multiplyAlpha(self, mask):
+        """ Multiply the layer alpha by a (height, width) float array in the 0..1 range """
+        if not self.layer.has_alpha:
+            gimp.pdb.gimp_layer_add_alpha(self.layer)
+        pixels = getPixels(self.layer, 0, 0, self.layer.width, self.layer.height).copy()
+        pixels[:, :, -1] = (pixels[:, :, -1] * mask).astype(numpy.uint8)
+        setPixels(self.layer, 0, 0, pixels)
+        return self
+
     def saveMaskAs(self, filepath):
         gimp.pdb.file_png_save(self.image, self.layer.mask, filepath, filepath, False, 9, True, True, True, True, True)
         return self
@@ -718,14 +2595,12 @@ class Layer():
     def maskToBase64(self):
         filepath = TempFiles().get("mask"+str(self.id)+".png")
         self.saveMaskAs(filepath)
-        file = open(filepath, "rb")
-        return base64.b64encode(file.read())
+        return Base64File(filepath)
 
     def toBase64(self):
         filepath = TempFiles().get("layer"+str(self.id)+".png")
         self.saveAs(filepath)
-        file = open(filepath, "rb")
-        return base64.b64encode(file.read())
+        return Base64File(filepath)
 
     def remove(self):
         gimp.pdb.gimp_image_remove_layer(self.layer.image, self.layer)
@@ -733,12 +2608,21 @@ class Layer():
 
 
 class ResponseLayers():
+    """ Inserts the generated images into a hidden layer group, transforms are applied to the group once
+    and show() reveals it, so the image projection is only recomputed at the end. Used as a context manager,
+    show() also runs when a transform fails, so the undo group is always closed. """
     def __init__(self, img, response, options = {}):
         self.image = img
         color = gimp.pdb.gimp_context_get_foreground()
         gimp.pdb.gimp_context_set_foreground((0, 0, 0))
+        gimp.pdb.gimp_image_undo_group_start(img)
+
+        self.group = gimp.pdb.gimp_layer_group_new(img)
+        gimp.pdb.gimp_item_set_visible(self.group, False)
+        gimp.pdb.gimp_image_insert_layer(img, self.group, None, -1)
 
         layers = []
+        annotator_layers = []
         try:
             info = json.loads(response["info"])
             infotexts = info["infotexts"]
@@ -747,55 +2631,101 @@ class ResponseLayers():
             logging.debug(infotexts)
             logging.debug(seeds)
             total_images = len(seeds)
+            gimp.pdb.gimp_item_set_name(self.group, "Generated Layers "+str(seeds[0]))
             for image in response["images"]:
                 if index < total_images:
                     layer_data = {"info": infotexts[index], "seed": seeds[index]}
-                    layer = Layer.fromBase64(img, image).rename("Generated Layer "+str(seeds[index])).saveData(layer_data).insertTo(img)
+                    for key in ("plan", "target", "selection"):
+                        if options.get(key) is not None:
+                            layer_data[key] = options[key]
+                    layer = Layer.fromBase64(img, image).rename("Generated Layer "+str(seeds[index])).saveData(layer_data).insertTo(img, self.group, index)
+                    # only the first result is visible, the rest are one click away
+                    gimp.pdb.gimp_item_set_visible(layer.layer, index == 0)
+                    if options.get("region") is not None:
+                        layer.cropToRegion(options["region"], img.width, img.height)
+                        if options.get("mask") is not None:
+                            layer.multiplyAlpha(options["mask"])
+                    layers.append(layer.layer)
                 else:
                     # annotator layers
                     if "skip_annotator_layers" in options and not options["skip_annotator_layers"]:
                         layer = Layer.fromBase64(img, image).rename("Annotator Layer").insertTo(img)
-                layers.append(layer.layer)
+                        if options.get("region") is not None:
+                            # the maps are of the whole canvas, and the caller only transforms the region results
+                            layer.resize(img.width, img.height)
+                        annotator_layers.append(layer.layer)
                 index += 1
         except Exception as e:
             logging.exception("ResponseLayers")
 
         gimp.pdb.gimp_context_set_foreground(color)
         self.layers = layers
+        self.annotator_layers = annotator_layers
+        self.shown = False
 
     def scale(self, new_scale=1.0):
         if new_scale != 1.0:
-            for layer in self.layers:
+            if self.layers:
+                Layer(self.group).scale(new_scale)
+            for layer in self.annotator_layers:
                 Layer(layer).scale(new_scale)
         return self
 
     def resize(self, width, height):
-        for layer in self.layers:
+        if self.layers:
+            Layer(self.group).resize(width, height)
+        for layer in self.annotator_layers:
             Layer(layer).resize(width, height)
         return self
 
     def translate(self, offset=None):
         if offset is not None:
-            for layer in self.layers:
+            if self.layers:
+                Layer(self.group).translate(offset)
+            for layer in self.annotator_layers:
                 Layer(layer).translate(offset)
         return self
 
-    def insertTo(self, image=None):
-        image = image or self.image
+    def multiplyAlpha(self, mask):
+        """ Multiply the alpha of every result by a mask the size of the results """
         for layer in self.layers:
-            Layer(layer).insertTo(image)
+            Layer(layer).multiplyAlpha(mask)
         return self
 
     def addSelectionAsMask(self):
         non_empty, x1, y1, x2, y2 = gimp.pdb.gimp_selection_bounds(self.image)
         if not non_empty:
-            return
+            return self
         if (x1 == 0) and (y1 == 0) and (x2 - x1 == self.image.width) and (y2 - y1 == self.image.height):
-            return
-        for layer in self.layers:
+            return self
+        if self.layers:
+            Layer(self.group).addSelectionAsMask()
+        for layer in self.annotator_layers:
             Layer(layer).addSelectionAsMask()
         return self
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.show()
+        return False
+
+    def show(self):
+        """ Reveal the results and close the undo group """
+        if self.shown:
+            return self
+        self.shown = True
+        try:
+            if self.layers:
+                gimp.pdb.gimp_item_set_visible(self.group, True)
+            else:
+                gimp.pdb.gimp_image_remove_layer(self.image, self.group)
+        finally:
+            gimp.pdb.gimp_image_undo_group_end(self.image)
+            gimp.displays_flush()
+        return self
+
 def handleConfig(image, drawable, *args):
     print((image, drawable, args))
     StableGimpfusionPlugin(image).config(*args)
@@ -813,9 +2743,33 @@ def handleInpainting(image, drawable, *args):
 def handleTextToImage(image, drawable, *args):
     StableGimpfusionPlugin(image).textToImage(*args)
 
+def handleSubmitTextToImage(image, drawable, *args):
+    StableGimpfusionPlugin(image).submitTextToImage(*args)
+
+def handleCollectResults(image, drawable, *args):
+    StableGimpfusionPlugin(image).collectResults(*args)
+
+def handleRegionInpainting(image, drawable, *args):
+    StableGimpfusionPlugin(image).regionInpainting(*args)
+
+def handleLoopback(image, drawable, *args):
+    StableGimpfusionPlugin(image).loopback(*args)
+
+def handleOutpainting(image, drawable, *args):
+    StableGimpfusionPlugin(image).outpainting(*args)
+
 def handleControlNetLayerConfig(image, drawable, *args):
     StableGimpfusionPlugin(image).saveControlLayer(*args)
 
+def handleShowPerformanceReport(image, drawable, *args):
+    StableGimpfusionPlugin(image).showPerformanceReport(*args)
+
+def handlePreviewControlNetMap(image, drawable, *args):
+    StableGimpfusionPlugin(image).previewControlNetMap(*args)
+
+def handleFitResults(image, drawable, *args):
+    StableGimpfusionPlugin(image).fitResults(*args)
+
 def handleShowLayerInfo(image, drawable, *args):
     StableGimpfusionPlugin(image).showLayerInfo(*args)
 
@@ -881,6 +2835,9 @@ def init_plugin():
         (gimpfu.PF_STRING, "prompt", "Prompt Suffix", settings.get("prompt")),
         (gimpfu.PF_STRING, "negative_prompt", "Negative Prompt Suffix", settings.get("negative_prompt")),
         (gimpfu.PF_STRING, "api_base", "Backend API URL base", settings.get("api_base")),
+        (gimpfu.PF_SLIDER, "target_seconds", "Target Latency in Seconds (0 = off)", settings.get("target_seconds", 0), (0, 120, 1)),
+        (gimpfu.PF_SLIDER, "prefetch_count", "Prefetch Next Seeds (0 = off)", settings.get("prefetch_count", 0), (0, 20, 1)),
+        (gimpfu.PF_STRING, "shard_backends", "Extra Backend URLs for Batches (comma separated)", settings.get("shard_backends", "")),
         ]
 
     logging.info(models)
@@ -898,9 +2855,29 @@ def init_plugin():
     PLUGIN_FIELDS_INPAINTING = [
         (gimpfu.PF_TOGGLE, "invert_mask", "Invert Mask", False),
         (gimpfu.PF_TOGGLE, "inpaint_full_res", "Inpaint Whole Picture", True),
+        (gimpfu.PF_TOGGLE, "composite_in_place", "Keep only the masked area", True),
         ]
 
 
+    PLUGIN_FIELDS_LOOPBACK = [
+        (gimpfu.PF_SLIDER, "iterations", "Loopback Iterations", 4, (1, 32, 1)),
+        (gimpfu.PF_SLIDER, "final_denoising_strength", "Final Denoising Strength", 0.3, (0.0, 1.0, 0.01)),
+        (gimpfu.PF_TOGGLE, "keep_snapshots", "Keep Intermediate Results", False),
+        ]
+
+    # for procedures that derive the batch and the generation size themselves
+    PLUGIN_FIELDS_COMMON_SINGLE = [field for field in PLUGIN_FIELDS_COMMON if field[1] not in ("batch_size", "width", "height")]
+    PLUGIN_FIELDS_REGION_INPAINTING = [] + PLUGIN_FIELDS_COMMON_SINGLE + [
+        (gimpfu.PF_SLIDER, "padding", "Region Padding", 32, (0, 256, 8)),
+        (gimpfu.PF_TOGGLE, "include_paths", "Include Paths", False),
+        ]
+    PLUGIN_FIELDS_OUTPAINTING = [] + PLUGIN_FIELDS_COMMON_SINGLE + [
+        (gimpfu.PF_INT32, "new_width", "New Canvas Width", 1024),
+        (gimpfu.PF_INT32, "new_height", "New Canvas Height", 1024),
+        (gimpfu.PF_OPTION, "anchor", "Anchor", 0, [name for name, fx, fy in OUTPAINTING_ANCHORS]),
+        (gimpfu.PF_SLIDER, "context_margin", "Context Margin", 64, (0, 512, 8)),
+        ]
+
     PLUGIN_FIELDS_CONTROLNET = [] + [
             (gimpfu.PF_OPTION, "module", "Module", 0, CONTROLNET_MODULES),
             (gimpfu.PF_OPTION, "model", "Model", 0, settings.get("cn_models", ["none"])),
@@ -944,6 +2921,20 @@ def init_plugin():
             handleChangeModel, menu="<Image>/GimpFusion/Config"
             )
 
+    gimpfu.register(
+            "stable-gimpfusion-performance-report",
+            "Show generation latency percentiles per backend, checkpoint, resolution, steps and batch size",
+            "Performance report",
+            "ArtBIT",
+            "ArtBIT",
+            "2023",
+            "Performance report",
+            "*",
+            [] + PLUGIN_FIELDS_IMAGE,
+            [],
+            handleShowPerformanceReport, menu="<Image>/GimpFusion/Config"
+            )
+
     gimpfu.register(
             "stable-gimpfusion-txt2img",
             "Text to image",
@@ -959,6 +2950,34 @@ def init_plugin():
             )
 
 
+    gimpfu.register(
+            "stable-gimpfusion-txt2img-background",
+            "Submit a text to image job and keep working while it runs, use Collect results to insert the results",
+            "Text to image in the background",
+            "ArtBIT",
+            "ArtBIT",
+            "2023",
+            "Text to image (background)",
+            "*",
+            []+ PLUGIN_FIELDS_IMAGE + PLUGIN_FIELDS_TXT2IMG,
+            [],
+            handleSubmitTextToImage, menu="<Image>/GimpFusion"
+            )
+
+    gimpfu.register(
+            "stable-gimpfusion-collect-results",
+            "Insert the results of finished background jobs",
+            "Collect results",
+            "ArtBIT",
+            "ArtBIT",
+            "2023",
+            "Collect results",
+            "*",
+            []+ PLUGIN_FIELDS_IMAGE,
+            [],
+            handleCollectResults, menu="<Image>/GimpFusion"
+            )
+
     gimpfu.register(
             "stable-gimpfusion-txt2img-context",
             "Text to image",
@@ -988,6 +3007,20 @@ def init_plugin():
             handleImageToImage, menu="<Image>/GimpFusion"
             )
 
+    gimpfu.register(
+            "stable-gimpfusion-img2img-loopback",
+            "Refine the active layer with several image to image passes, each feeding the previous result back in",
+            "Image to image loopback",
+            "ArtBIT",
+            "ArtBIT",
+            "2023",
+            "Image to image (loopback)",
+            "*",
+            []+ PLUGIN_FIELDS_IMAGE + PLUGIN_FIELDS_IMG2IMG + PLUGIN_FIELDS_LOOPBACK,
+            [],
+            handleLoopback, menu="<Image>/GimpFusion"
+            )
+
     gimpfu.register(
             "stable-gimpfusion-img2img-context",
             "Image to image",
@@ -1025,11 +3058,39 @@ def init_plugin():
             "2023",
             "Inpainting",
             "*",
-            [] + PLUGIN_FIELDS_LAYERS + PLUGIN_FIELDS_IMG2IMG,
+            [] + PLUGIN_FIELDS_LAYERS + PLUGIN_FIELDS_IMG2IMG + PLUGIN_FIELDS_INPAINTING,
             [],
             handleInpaintingFromLayersContext, menu="<Layers>/GimpFusion"
             )
 
+    gimpfu.register(
+            "stable-gimpfusion-region-inpainting",
+            "Inpaint every saved selection channel at once, using the channel name as the prompt for its region",
+            "Inpaint saved selections",
+            "ArtBIT",
+            "ArtBIT",
+            "2023",
+            "Inpaint saved selections",
+            "*",
+            []+ PLUGIN_FIELDS_IMAGE + PLUGIN_FIELDS_REGION_INPAINTING,
+            [],
+            handleRegionInpainting, menu="<Image>/GimpFusion"
+            )
+
+    gimpfu.register(
+            "stable-gimpfusion-outpainting",
+            "Extend the canvas and generate only the new border strips",
+            "Outpainting",
+            "ArtBIT",
+            "ArtBIT",
+            "2023",
+            "Outpainting",
+            "*",
+            []+ PLUGIN_FIELDS_IMAGE + PLUGIN_FIELDS_OUTPAINTING,
+            [],
+            handleOutpainting, menu="<Image>/GimpFusion"
+            )
+
     gimpfu.register(
             "stable-gimpfusion-config-controlnet-layer",
             "Convert current layer to ControlNet layer or edit ControlNet Layer's options",
@@ -1058,6 +3119,34 @@ def init_plugin():
             handleControlNetLayerConfigFromLayersContext, menu="<Layers>/GimpFusion"
             )
 
+    gimpfu.register(
+            "stable-gimpfusion-fit-results",
+            "Scale the kept text to image results to the selection they were generated for",
+            "Fit results to selection",
+            "ArtBIT",
+            "ArtBIT",
+            "2023",
+            "Fit results to selection",
+            "*",
+            [] + PLUGIN_FIELDS_IMAGE,
+            [],
+            handleFitResults, menu="<Image>/GimpFusion"
+            )
+
+    gimpfu.register(
+            "stable-gimpfusion-preview-controlnet-map",
+            "Insert the preprocessed map of the active ControlNet layer as a new layer",
+            "Preview ControlNet map",
+            "ArtBIT",
+            "ArtBIT",
+            "2023",
+            "Preview ControlNet map",
+            "*",
+            [] + PLUGIN_FIELDS_IMAGE,
+            [],
+            handlePreviewControlNetMap, menu="<Image>/GimpFusion"
+            )
+
     gimpfu.register(
             "stable-gimpfusion-layer-info",
             "Show stable gimpfusion info associated with this layer",
@@ -1086,6 +3175,275 @@ def init_plugin():
             handleShowLayerInfoContext, menu="<Layers>/GimpFusion"
             )
 
-init_plugin()
-gimpfu.main()
+def replay_trace(trace_path, base_url, speed):
+    """ Re-issue a recorded trace against base_url, keeping the recorded pacing divided by speed """
+    trace = TrafficRecorder(trace_path)
+    entries = trace.load()
+    if not entries:
+        print("Trace %s is empty" % trace_path)
+        return 1
+    client = ApiClient(base_url)
+    client.recorder = None
+    results = [None] * len(entries)
+    first_started = entries[0]["started"]
+    replay_started = time.time()
+
+    def run(index, entry):
+        delay = (entry["started"] - first_started) / speed - (time.time() - replay_started)
+        if delay > 0:
+            time.sleep(delay)
+        started = time.time()
+        if entry["method"] == "POST":
+            response = client.post(entry["endpoint"], trace.restore(entry["request"]), entry["params"])
+        else:
+            response = client.get(entry["endpoint"], entry["params"])
+        results[index] = (time.time() - started, response is not None)
+
+    threads = []
+    for index, entry in enumerate(entries):
+        thread = threading.Thread(target=run, args=(index, entry))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    failures = 0
+    for entry, (duration, ok) in zip(entries, results):
+        failures += 0 if ok else 1
+        print("%-4s %-32s recorded %7.2fs  replayed %7.2fs  %s" % (entry["method"], entry["endpoint"], entry["duration"], duration, "ok" if ok else "FAILED"))
+    print("%d requests, %d failed, wall time %.2fs (recorded %.2fs)" % (len(entries), failures,
+        time.time() - replay_started,
+        entries[-1]["started"] + entries[-1]["duration"] - first_started))
+    return 1 if failures else 0
+
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+def readRequestBody(handler):
+    """ The body of the request a BaseHTTPRequestHandler is handling, plain or chunked """
+    if handler.headers.get("Transfer-Encoding", "").lower() == "chunked":
+        chunks = []
+        while True:
+            size = int(handler.rfile.readline().split(";")[0].strip(), 16)
+            chunks.append(handler.rfile.read(size + 2)[:size])
+            if size == 0:
+                return "".join(chunks)
+    return handler.rfile.read(int(handler.headers.get("Content-Length") or 0))
+
+def run_mock_server(trace_path, port, speed):
+    """ Serve the responses of a recorded trace, taking the recorded time divided by speed """
+    trace = TrafficRecorder(trace_path)
+    recorded = {}
+    for entry in trace.load():
+        recorded.setdefault((entry["method"], entry["endpoint"]), []).append(entry)
+    counters = {}
+    lock = threading.Lock()
+
+    class MockHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def respond(self, method):
+            endpoint = urlparse.urlsplit(self.path).path
+            entries = recorded.get((method, endpoint))
+            if not entries:
+                body = json.dumps({"detail": "Not recorded"})
+                status = 404
+            else:
+                with lock:
+                    index = counters.get((method, endpoint), 0)
+                    counters[(method, endpoint)] = index + 1
+                entry = entries[index % len(entries)]
+                time.sleep(entry["duration"] / speed)
+                body = json.dumps(trace.restore(entry["response"], False))
+                status = entry["status"] or 200
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            self.respond("GET")
+
+        def do_POST(self):
+            readRequestBody(self)
+            self.respond("POST")
+
+    server = ThreadedHTTPServer(("127.0.0.1", port), MockHandler)
+    print("Serving %s on http://127.0.0.1:%d" % (trace_path, port))
+    server.serve_forever()
+    return 0
+
+class JobQueue():
+    """ Admission control for the backend: priority classes are served strictly in order,
+    users within a class take turns, and each user's requests keep their arrival order """
+    def __init__(self, slots=1):
+        self.condition = threading.Condition()
+        self.slots = slots
+        self.waiting = []
+        self.running = {}
+        self.last_served = {}
+        self.counter = 0
+
+    def order(self):
+        return sorted(self.waiting, key=lambda ticket: (QUEUE_PRIORITIES.index(ticket["priority"]), self.last_served.get(ticket["user"], 0), ticket["arrival"]))
+
+    def acquire(self, ticket_id, user, priority):
+        with self.condition:
+            self.counter += 1
+            ticket = {"id": ticket_id, "user": user, "priority": priority if priority in QUEUE_PRIORITIES else "normal", "arrival": self.counter}
+            self.waiting.append(ticket)
+            while len(self.running) >= self.slots or self.order()[0] is not ticket:
+                self.condition.wait()
+            self.waiting.remove(ticket)
+            self.running[ticket_id] = ticket
+            self.counter += 1
+            self.last_served[user] = self.counter
+            # other waiting requests may be next now
+            self.condition.notify_all()
+
+    def release(self, ticket_id):
+        with self.condition:
+            self.running.pop(ticket_id, None)
+            self.condition.notify_all()
+
+    def status(self, ticket_id=None):
+        """ The position of a ticket (0 once it is running, None if unknown), or the whole queue """
+        with self.condition:
+            if ticket_id is None:
+                describe = lambda ticket: {"user": ticket["user"], "priority": ticket["priority"]}
+                return {"running": [describe(ticket) for ticket in self.running.values()], "waiting": [describe(ticket) for ticket in self.order()]}
+            if ticket_id in self.running:
+                return {"position": 0, "running": True}
+            for position, ticket in enumerate(self.order()):
+                if ticket["id"] == ticket_id:
+                    return {"position": position + 1, "running": False}
+            return {"position": None, "running": False}
+
+def run_queue_server(backend, port, slots):
+    """ Proxy a backend shared by several plugin instances, generation requests wait in a JobQueue """
+    queue = JobQueue(slots)
+    backend_parts = urlparse.urlsplit(backend)
+    hop_headers = ["connection", "keep-alive", "transfer-encoding", "content-length", "host"]
+
+    class QueueHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def forward(self, method, body=None, skip_headers=[]):
+            if backend_parts.scheme == "https":
+                connection = httplib.HTTPSConnection(backend_parts.netloc)
+            else:
+                connection = httplib.HTTPConnection(backend_parts.netloc)
+            try:
+                headers = dict((name, value) for name, value in self.headers.items() if name.lower() not in hop_headers + skip_headers and not name.lower().startswith("x-gimpfusion-"))
+                connection.request(method, backend_parts.path.rstrip("/") + self.path, body, headers)
+                response = connection.getresponse()
+                length = response.getheader("Content-Length")
+                content = None if length is not None else response.read()
+                self.send_response(response.status, response.reason)
+                for name, value in response.getheaders():
+                    if name.lower() not in hop_headers:
+                        self.send_header(name, value)
+                self.send_header("Content-Length", length if length is not None else str(len(content)))
+                self.send_header(ACCEPT_ENCODING_HEADER, "gzip")
+                self.end_headers()
+                if content is not None:
+                    self.wfile.write(content)
+                else:
+                    while True:
+                        chunk = response.read(RESPONSE_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        self.wfile.write(chunk)
+            finally:
+                connection.close()
+
+        def sendJson(self, data, status=200):
+            body = json.dumps(data)
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header(ACCEPT_ENCODING_HEADER, "gzip")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            parts = urlparse.urlsplit(self.path)
+            if parts.path == QUEUE_STATUS_ENDPOINT:
+                ticket_id = urlparse.parse_qs(parts.query).get("ticket", [None])[0]
+                return self.sendJson(queue.status(ticket_id))
+            try:
+                self.forward("GET")
+            except Exception as ex:
+                logging.exception("ERROR: QueueHandler.do_GET")
+                self.sendJson({"detail": repr(ex)}, 502)
+
+        def do_POST(self):
+            body = readRequestBody(self)
+            # the backend takes plain bodies only
+            skip_headers = []
+            if (self.headers.get("Content-Encoding") or "").lower() == "gzip":
+                body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+                skip_headers = ["content-encoding"]
+            ticket_id = self.headers.get("X-GimpFusion-Ticket") or str(uuid.uuid4())
+            queue.acquire(ticket_id, self.headers.get("X-GimpFusion-User") or self.client_address[0], self.headers.get("X-GimpFusion-Priority", "normal"))
+            try:
+                self.forward("POST", body, skip_headers)
+            except Exception as ex:
+                logging.exception("ERROR: QueueHandler.do_POST")
+                self.sendJson({"detail": repr(ex)}, 502)
+            finally:
+                queue.release(ticket_id)
+
+    server = ThreadedHTTPServer(("0.0.0.0", port), QueueHandler)
+    print("Queueing requests to %s on port %d" % (backend, port))
+    server.serve_forever()
+    return 0
+
+CLI_COMMANDS = ["replay", "mock-server", "queue-server", "worker", "prefetch"]
+
+def main(argv):
+    """ Command line tools, run with `python stable_gimpfusion.py <command>` """
+    parser = argparse.ArgumentParser(prog="stable_gimpfusion.py", description="Stable Gimpfusion command line tools")
+    subparsers = parser.add_subparsers(dest="command")
+
+    replay = subparsers.add_parser("replay", help="Re-issue a recorded trace against a backend")
+    replay.add_argument("trace", help="Trace directory (GIMPFUSION_TRACE)")
+    replay.add_argument("--url", default="http://127.0.0.1:7861", help="Backend API URL base")
+    replay.add_argument("--speed", type=float, default=1.0, help="Pacing acceleration factor")
+
+    mock = subparsers.add_parser("mock-server", help="Serve recorded responses as a local mock backend")
+    mock.add_argument("trace", help="Trace directory (GIMPFUSION_TRACE)")
+    mock.add_argument("--port", type=int, default=7861)
+    mock.add_argument("--speed", type=float, default=1.0, help="Response time acceleration factor")
+
+    queue_server = subparsers.add_parser("queue-server", help="Share one backend between several plugin instances")
+    queue_server.add_argument("--backend", default="http://127.0.0.1:7860", help="Backend API URL base")
+    queue_server.add_argument("--port", type=int, default=7870)
+    queue_server.add_argument("--slots", type=int, default=1, help="Requests forwarded to the backend at the same time")
+
+    worker = subparsers.add_parser("worker", help="Run a background job, started by the plugin")
+    worker.add_argument("job", help="Job directory")
+
+    prefetch = subparsers.add_parser("prefetch", help="Generate the next seeds of a payload while the backend is idle, started by the plugin")
+    prefetch.add_argument("job", help="Prefetch job directory")
+
+    args = parser.parse_args(argv)
+    if args.command == "replay":
+        return replay_trace(args.trace, args.url, args.speed)
+    if args.command == "mock-server":
+        return run_mock_server(args.trace, args.port, args.speed)
+    if args.command == "queue-server":
+        return run_queue_server(args.backend, args.port, args.slots)
+    if args.command == "worker":
+        return BackgroundJobs().run(args.job)
+    if args.command == "prefetch":
+        return PrefetchCache().run(args.job)
+
+if __name__ == "__main__" and len(sys.argv) > 1 and sys.argv[1] in CLI_COMMANDS:
+    sys.exit(main(sys.argv[1:]))
+elif gimpfu is not None:
+    init_plugin()
+    gimpfu.main()
 
@@ -0,0 +1,121 @@
+import base64
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import stable_gimpfusion
+
+
+class PlanResolutionTest(unittest.TestCase):
+    def test_keeps_square_targets_at_the_budget(self):
+        self.assertEqual(stable_gimpfusion.planResolution(512, 512, 512 * 512), (512, 512))
+
+    def test_accepts_float_budgets(self):
+        # the width and height settings come from sliders, roundToMultiple keeps them floats
+        budget = stable_gimpfusion.roundToMultiple(512, 8) ** 2
+        self.assertEqual(stable_gimpfusion.planResolution(300, 200, budget), (576, 384))
+
+    def test_follows_the_aspect_ratio_within_the_budget(self):
+        width, height = stable_gimpfusion.planResolution(1920, 1080, 512 * 512)
+        self.assertEqual((width % 64, height % 64), (0, 0))
+        self.assertLessEqual(width * height, 512 * 512)
+        self.assertAlmostEqual(float(width) / height, 1920.0 / 1080, delta=0.1)
+
+    def test_extreme_aspect_ratios_are_symmetric(self):
+        self.assertEqual(stable_gimpfusion.planResolution(2000, 20, 512 * 512), (4096, 64))
+        self.assertEqual(stable_gimpfusion.planResolution(20, 2000, 512 * 512), (64, 4096))
+        self.assertEqual(stable_gimpfusion.planResolution(1080, 1920, 512 * 512), (320, 576))
+
+
+class ShardPayloadTest(unittest.TestCase):
+    def test_continues_the_seeds_of_a_single_batch(self):
+        payloads = stable_gimpfusion.shardPayload({"batch_size": 20.0, "seed": 100, "subseed": 7}, 3)
+        self.assertEqual([payload["batch_size"] for payload in payloads], [7, 7, 6])
+        self.assertEqual([payload["seed"] for payload in payloads], [100, 107, 114])
+        self.assertEqual([payload["subseed"] for payload in payloads], [7, 14, 21])
+        self.assertTrue(all(isinstance(payload["seed"], int) for payload in payloads))
+
+    def test_batches_smaller_than_the_backends(self):
+        payloads = stable_gimpfusion.shardPayload({"batch_size": 2.0, "seed": 100.0, "subseed": 7}, 3)
+        self.assertEqual([(payload["batch_size"], payload["seed"]) for payload in payloads], [(1, 100), (1, 101)])
+
+    def test_variations_count_up_the_subseed(self):
+        payloads = stable_gimpfusion.shardPayload({"batch_size": 4, "seed": 5, "subseed": 9, "subseed_strength": 0.3}, 2)
+        self.assertEqual([(payload["seed"], payload["subseed"]) for payload in payloads], [(5, 9), (5, 11)])
+
+
+@unittest.skipIf(stable_gimpfusion.numpy is None, "needs NumPy")
+class BorderMaskTest(unittest.TestCase):
+    def test_fades_out_within_the_context(self):
+        mask = stable_gimpfusion.getBorderMask((90, 0, 30, 2), (100, 0, 20, 2), 1)
+        self.assertTrue((mask[:, 10:] == 1.0).all())
+        self.assertTrue((mask[:, :4] == 0.0).all())
+        self.assertTrue((mask[0, 4:10] > 0.0).all() and (mask[0, 4:10] < 1.0).all())
+
+    def test_limits_the_feather_to_the_context(self):
+        mask = stable_gimpfusion.getBorderMask((0, 0, 20, 3), (0, 0, 10, 3), 10)
+        self.assertEqual(mask[1, -1], 0.0)
+
+
+class ResponseReaderTest(unittest.TestCase):
+    response = ('{"info": "images", "parameters": {"images": ["kept"], "prompt": "a \\"cat\\" \\\\"}, '
+        '"images": ["one\\"1\\\\", "two", "th\\"ree"]}')
+
+    def read(self, text, max_images=None, size=None):
+        reader = stable_gimpfusion.ResponseReader(max_images)
+        size = size or len(text)
+        for start in range(0, len(text), size):
+            reader.feed(text[start:start + size])
+        return reader.result()
+
+    def test_reads_everything_without_a_limit(self):
+        self.assertEqual(self.read(self.response), json.loads(self.response))
+
+    def test_chunk_boundaries_inside_escapes_and_quotes(self):
+        expected = json.loads(self.response)
+        for size in range(1, 12):
+            self.assertEqual(self.read(self.response, size=size), expected)
+        self.assertEqual(self.read(self.response, 1, size=1)["images"], ['one"1\\'])
+
+    def test_escaped_quotes_in_image_strings(self):
+        self.assertEqual(self.read(self.response, 3)["images"], ['one"1\\', "two", 'th"ree'])
+
+    def test_drops_images_past_max_images(self):
+        self.assertEqual(self.read(self.response, 0)["images"], [])
+        self.assertEqual(self.read(self.response, 2)["images"], ['one"1\\', "two"])
+        self.assertEqual(self.read(self.response, 5)["images"], ['one"1\\', "two", 'th"ree'])
+
+    def test_only_the_top_level_images_are_dropped(self):
+        data = self.read(self.response, 0)
+        self.assertEqual(data["parameters"], {"images": ["kept"], "prompt": 'a "cat" \\'})
+        self.assertEqual(data["info"], "images")
+
+    def test_string_value_equal_to_images(self):
+        text = '{"info": "images", "other": ["a", "b"], "images": ["c", "d"]}'
+        self.assertEqual(self.read(text, 1), {"info": "images", "other": ["a", "b"], "images": ["c"]})
+
+
+class IterJsonTest(unittest.TestCase):
+    def test_round_trips_through_json_loads(self):
+        for data in [{}, [], {"a": [1, 2.5, None, True], "b": {"c": 'quote " and \\ slash'}, "d": []},
+                [{"x": {}}, "text", -3], u"unicode \u00e9"]:
+            self.assertEqual(json.loads("".join(stable_gimpfusion.iterjson(data))), data)
+
+    def test_streams_base64_files(self):
+        handle, path = tempfile.mkstemp()
+        try:
+            os.write(handle, b"\x00\xffpixels" * 1000)
+            os.close(handle)
+            data = {"init_images": [stable_gimpfusion.Base64File(path)], "steps": 20}
+            text = "".join(stable_gimpfusion.iterjson(data))
+            self.assertEqual(json.loads(text), {"init_images": [base64.b64encode(b"\x00\xffpixels" * 1000).decode("ascii")], "steps": 20})
+        finally:
+            os.remove(path)
+
+
+if __name__ == "__main__":
+    unittest.main()